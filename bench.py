@@ -0,0 +1,219 @@
+# قياس أداء /extract-video بدون أي اتصال بالإنترنت
+#
+#   python bench.py --requests 2000 --concurrency 64 --latency 0.2 --videos 50
+#
+# يستبدل YoutubeDL بمستخرج وهمي يعيد بيانات مسجلة (أو مولدة) بعد تأخير قابل للضبط،
+# ثم يرسل الطلبات مباشرة إلى تطبيق ASGI ويطبع زمن الاستجابة (p50/p95/p99) وعدد الطلبات
+# في الثانية واستهلاك الذاكرة.
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import string
+import time
+
+# المستخرج الوهمي يعمل داخل نفس العملية، لذلك نفرض مجمع الخيوط قبل استيراد main
+os.environ["EXTRACT_POOL"] = "thread"
+# كل الطلبات تأتي من نفس العميل، فنرفع حد المعدل حتى لا نقيس الرفض بدل الأداء
+os.environ.setdefault("RATE_LIMIT_RATE", "1000000")
+os.environ.setdefault("RATE_LIMIT_BURST", "1000000")
+# ذاكرة القرص تبقى بين التشغيلات، فنعطلها افتراضياً حتى تكون القياسات قابلة للتكرار
+os.environ.setdefault("CACHE_DB", "")
+
+# (format_id, ext, height, vcodec, acodec, tbr)
+_YOUTUBE_FORMATS = [
+    ("sb3", "mhtml", 45, "none", "none", None),
+    ("sb2", "mhtml", 90, "none", "none", None),
+    ("sb1", "mhtml", 45, "none", "none", None),
+    ("sb0", "mhtml", 90, "none", "none", None),
+    ("139", "m4a", None, "none", "mp4a.40.5", 48.8),
+    ("249", "webm", None, "none", "opus", 53.2),
+    ("250", "webm", None, "none", "opus", 69.5),
+    ("140", "m4a", None, "none", "mp4a.40.2", 129.5),
+    ("251", "webm", None, "none", "opus", 135.9),
+    ("160", "mp4", 144, "avc1.4d400c", "none", 79.0),
+    ("278", "webm", 144, "vp9", "none", 82.1),
+    ("133", "mp4", 240, "avc1.4d4015", "none", 151.4),
+    ("242", "webm", 240, "vp9", "none", 163.2),
+    ("134", "mp4", 360, "avc1.4d401e", "none", 334.8),
+    ("18", "mp4", 360, "avc1.42001E", "mp4a.40.2", 493.1),
+    ("243", "webm", 360, "vp9", "none", 299.6),
+    ("135", "mp4", 480, "avc1.4d401f", "none", 645.9),
+    ("244", "webm", 480, "vp9", "none", 534.5),
+    ("136", "mp4", 720, "avc1.4d401f", "none", 1187.3),
+    ("22", "mp4", 720, "avc1.64001F", "mp4a.40.2", 1320.4),
+    ("247", "webm", 720, "vp9", "none", 1042.8),
+    ("298", "mp4", 720, "avc1.4d4020", "none", 1715.0),
+    ("302", "webm", 720, "vp9", "none", 1598.1),
+    ("137", "mp4", 1080, "avc1.640028", "none", 4302.7),
+    ("248", "webm", 1080, "vp9", "none", 2624.6),
+    ("299", "mp4", 1080, "avc1.64002a", "none", 5764.9),
+    ("303", "webm", 1080, "vp9", "none", 3113.9),
+]
+
+
+def _signed_url(video_id, format_id, expire):
+    # روابط googlevideo طويلة، وطولها مهم لقياس الترميز وحجم الاستجابة
+    sig = "".join(random.choices(string.ascii_letters + string.digits, k=120))
+    return (
+        f"https://rr3---sn-4g5e6nsz.googlevideo.com/videoplayback?expire={expire}"
+        f"&ei=AbCdEfGhIjKlMnOp&ip=203.0.113.7&id=o-{video_id}&itag={format_id}"
+        "&source=youtube&requiressl=yes&mh=xY&mm=31%2C29&mn=sn-4g5e6nsz%2Csn-4g5elsl7"
+        "&ms=au%2Crdu&mv=m&mvi=3&pl=24&initcwndbps=1392500&vprv=1&mime=video%2Fmp4"
+        f"&gir=yes&clen=12345678&dur=212.061&lmt=1700000000000000&mt=1700000000&fvip=5"
+        f"&keepalive=yes&c=IOS&txp=4532434&sparams=expire%2Cei%2Cip%2Cid%2Citag&sig={sig}"
+    )
+
+
+def make_info(video_id, expire_in=6 * 3600):
+    expire = int(time.time()) + expire_in
+    formats = []
+    for format_id, ext, height, vcodec, acodec, tbr in _YOUTUBE_FORMATS:
+        formats.append({
+            "format_id": format_id,
+            "ext": ext,
+            "height": height,
+            "width": height and height * 16 // 9,
+            "resolution": f"{height * 16 // 9}x{height}" if height else "audio only",
+            "vcodec": vcodec,
+            "acodec": acodec,
+            "tbr": tbr,
+            "filesize": int(tbr * 1000 / 8 * 212) if tbr else None,
+            "protocol": "mhtml" if ext == "mhtml" else "https",
+            "url": _signed_url(video_id, format_id, expire),
+        })
+    return {
+        "id": video_id,
+        "extractor_key": "Youtube",
+        "title": f"Benchmark video {video_id}",
+        "thumbnail": f"https://i.ytimg.com/vi/{video_id}/maxresdefault.jpg",
+        "duration": 212,
+        "formats": formats,
+    }
+
+
+class FakeYoutubeDL:
+    # بديل محلي لـ yt_dlp.YoutubeDL: نفس الواجهة التي يستخدمها main مع تأخير قابل للضبط
+    latency = 0.2
+    jitter = 0.05
+    recorded = {}
+
+    def __init__(self, params=None):
+        self.params = dict(params or {})
+        self._num_downloads = 0
+        self._num_videos = 0
+        self._download_retcode = 0
+        self._playlist_level = 0
+        self._playlist_urls = set()
+        self._printed_messages = set()
+
+    def extract_info(self, url, download=False, ie_key=None, **kwargs):
+        # time.sleep وليس asyncio.sleep: الاستخراج الحقيقي يحجب الخيط أثناء جلب الصفحة
+        time.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        video_id = url.rsplit("=", 1)[-1]
+        info = self.recorded.get(video_id)
+        if info is None:
+            info = make_info(video_id)
+        return json.loads(json.dumps(info))  # نسخة جديدة كما يفعل yt-dlp
+
+    def close(self):
+        pass
+
+
+def _percentile(sorted_values, p):
+    if not sorted_values:
+        return float("nan")
+    k = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+def _rss_mb():
+    # الذاكرة الحالية من /proc (لينكس)، والذروة من getrusage
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return float("nan")
+
+
+def _peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def run(args):
+    import httpx
+
+    import main
+
+    main.YDL_CLASS = FakeYoutubeDL
+
+    video_ids = list(FakeYoutubeDL.recorded) or [f"bench{i:06d}" for i in range(args.videos)]
+    urls = [f"https://www.youtube.com/watch?v={vid}" for vid in video_ids]
+
+    latencies = []
+    statuses = {}
+    sent = 0
+
+    async def worker(client):
+        nonlocal sent
+        while sent < args.requests:
+            sent += 1
+            url = random.choice(urls)
+            started = time.perf_counter()
+            resp = await client.post("/extract-video", json={"url": url})
+            await resp.aread()
+            latencies.append(time.perf_counter() - started)
+            statuses[resp.status_code] = statuses.get(resp.status_code, 0) + 1
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.lifespan(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            rss_before = _rss_mb()
+            started = time.perf_counter()
+            await asyncio.gather(*(worker(client) for _ in range(args.concurrency)))
+            elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"requests     {len(latencies)} in {elapsed:.2f}s ({len(latencies) / elapsed:.1f} req/s)")
+    print(f"concurrency  {args.concurrency}, videos {args.videos}, latency {args.latency}s ± {args.jitter}s")
+    print(f"status       {dict(sorted(statuses.items()))}")
+    for p in (50, 95, 99):
+        print(f"p{p:<11} {_percentile(latencies, p) * 1000:.2f} ms")
+    print(f"max          {latencies[-1] * 1000:.2f} ms")
+    print(f"rss          {rss_before:.1f} MB -> {_rss_mb():.1f} MB (peak {_peak_rss_mb():.1f} MB)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for /extract-video")
+    parser.add_argument("--requests", type=int, default=1000, help="total number of requests")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent clients")
+    parser.add_argument("--videos", type=int, default=100, help="distinct video IDs to spread requests over")
+    parser.add_argument("--latency", type=float, default=0.2, help="mean fake extraction latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.05, help="standard deviation of the latency")
+    parser.add_argument("--fixtures", help="JSON file with recorded info dicts (yt-dlp -J output, or a list of them)")
+    parser.add_argument("--no-cache", action="store_true", help="disable the metadata cache")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    FakeYoutubeDL.latency = args.latency
+    FakeYoutubeDL.jitter = args.jitter
+    if args.fixtures:
+        with open(args.fixtures) as f:
+            recorded = json.load(f)
+        if isinstance(recorded, dict):
+            recorded = [recorded]
+        FakeYoutubeDL.recorded = {info["id"]: info for info in recorded}
+    if args.no_cache:
+        os.environ["CACHE_MAX_ENTRIES"] = "0"
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
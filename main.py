@@ -1,9 +1,104 @@
-from fastapi import FastAPI, HTTPException
+import asyncio
+import bisect
+import gzip
+import ipaddress
+import json
+import math
+import os
+import re
+import resource
+import shutil
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import AsyncExitStack, aclosing, asynccontextmanager
+from functools import lru_cache
+from urllib.parse import quote
+
+from fastapi import FastAPI, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client import multiprocess
+from typing import Dict, List, NamedTuple, Optional
+
 from pydantic import BaseModel, HttpUrl
+import httpcore
+import httpx
 import yt_dlp
 
-app = FastAPI()
+# HTTP/2 متاح فقط إذا كانت مكتبة h2 مثبتة (httpx[http2])
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# orjson وbrotli اختياريان: بدونهما نستخدم json وgzip من المكتبة القياسية
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def _json_default(obj):
+    # Format (NamedTuple) يتحول إلى قائمة
+    if isinstance(obj, tuple):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj, default=_json_default)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def _loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content):
+        return _dumps(content)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # موارد مشتركة تعيش طوال عمر التطبيق
+    await upstream.start()
+    hub.loop = asyncio.get_running_loop()
+    refresher = asyncio.create_task(_refresh_loop())
+    await jobs.start()
+    try:
+        yield
+    finally:
+        await jobs.stop()
+        refresher.cancel()
+        await upstream.close()
+        gate.executor.shutdown(wait=False, cancel_futures=True)
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
 
 # إعداد CORS للسماح للواجهة بالاتصال بالخادم
 app.add_middleware(
@@ -14,41 +109,2490 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# إعدادات مجمع الاستخراج (يمكن تغييرها من متغيرات البيئة)
+EXTRACT_POOL = os.environ.get("EXTRACT_POOL", "thread")  # "thread" أو "process"
+EXTRACT_WORKERS = int(os.environ.get("EXTRACT_WORKERS", "8"))
+# أقصى عدد لعمليات الاستخراج المتزامنة، وأقصى عدد للطلبات المنتظرة في الطابور
+EXTRACT_MAX_INFLIGHT = int(os.environ.get("EXTRACT_MAX_INFLIGHT", str(EXTRACT_WORKERS)))
+EXTRACT_MAX_QUEUE = int(os.environ.get("EXTRACT_MAX_QUEUE", "64"))
+# رفض الطلب مبكراً (503 مع Retry-After) إذا كان الانتظار المتوقع في الطابور أطول من هذا
+EXTRACT_MAX_QUEUE_WAIT = float(os.environ.get("EXTRACT_MAX_QUEUE_WAIT", "15"))
+# تقدير أولي لمدة الاستخراج الواحد قبل أن نقيس المدة الفعلية
+EXTRACT_SERVICE_ESTIMATE = float(os.environ.get("EXTRACT_SERVICE_ESTIMATE", "2"))
+# مهلة كل طلب: العمل الذي ما زال في الطابور بعدها يُلغى لأن العميل غالباً غادر
+REQUEST_DEADLINE = float(os.environ.get("REQUEST_DEADLINE", "30"))
+# حدود كل عميل (IP أو مفتاح API): token bucket لعمليات الاستخراج، ووزن في الجدولة العادلة
+# يمكن تغييرها أثناء التشغيل عبر PUT /admin/limits (يتطلب ADMIN_TOKEN)
+RATE_LIMIT_RATE = float(os.environ.get("RATE_LIMIT_RATE", "2"))
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", "20"))
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+# عدد الـ proxies الموثوقة أمام الخادم (موازن Render مثلاً)؛ كل منها يضيف عنوان من اتصل به إلى نهاية
+# X-Forwarded-For، فعنوان العميل هو العنصر رقم TRUSTED_PROXY_HOPS من النهاية وما قبله قد يزوّره العميل
+TRUSTED_PROXY_HOPS = int(os.environ.get("TRUSTED_PROXY_HOPS", "0"))
+# كل كم ثانية نتحقق من أن العميل ما زال متصلاً أثناء انتظار الاستخراج
+DISCONNECT_POLL_INTERVAL = float(os.environ.get("DISCONNECT_POLL_INTERVAL", "0.5"))
+
+# إعدادات ذاكرة التخزين المؤقت للبيانات الوصفية
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", "1024"))
+CACHE_TTL = float(os.environ.get("CACHE_TTL", "3600"))
+# هامش أمان قبل انتهاء صلاحية الروابط الموقعة حتى لا نعيد رابطاً على وشك الموت
+CACHE_EXPIRY_MARGIN = float(os.environ.get("CACHE_EXPIRY_MARGIN", "300"))
+# في آخر CACHE_STALE_WINDOW ثانية قبل الانتهاء نعيد النسخة المخزنة فوراً ونجددها في الخلفية
+CACHE_STALE_WINDOW = float(os.environ.get("CACHE_STALE_WINDOW", "1800"))
+# العناصر المطلوبة كثيراً تُجدد في الخلفية قبل انتهاء صلاحية روابطها بقليل
+REFRESH_AHEAD = float(os.environ.get("REFRESH_AHEAD", "600"))
+REFRESH_MIN_HITS = int(os.environ.get("REFRESH_MIN_HITS", "5"))
+REFRESH_INTERVAL = float(os.environ.get("REFRESH_INTERVAL", "30"))
+# الأخطاء الدائمة (فيديو خاص، محذوف، محجوب جغرافياً ...) تُخزن لمدة قصيرة حتى لا نعيد الاستخراج
+NEGATIVE_TTL = float(os.environ.get("NEGATIVE_TTL", "120"))
+# قاطع الدائرة لكل مستخرج: يُفتح إذا تجاوزت نسبة الأخطاء الحد خلال النافذة الزمنية
+BREAKER_WINDOW = float(os.environ.get("BREAKER_WINDOW", "60"))
+BREAKER_MIN_CALLS = int(os.environ.get("BREAKER_MIN_CALLS", "20"))
+BREAKER_ERROR_RATE = float(os.environ.get("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_COOLDOWN = float(os.environ.get("BREAKER_COOLDOWN", "30"))
+# ذاكرة على القرص (SQLite بوضع WAL) يتشاركها كل عمال uvicorn على نفس الجهاز وتبقى بعد إعادة التشغيل
+# اترك CACHE_DB فارغاً لتعطيلها
+CACHE_DB = os.environ.get("CACHE_DB", os.path.join(tempfile.gettempdir(), "snapload-cache.sqlite3"))
+CACHE_DB_MAX_BYTES = int(os.environ.get("CACHE_DB_MAX_BYTES", str(256 * 1024 * 1024)))
+
+# إعدادات البث عبر الخادم (proxy)
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get("DOWNLOAD_CHUNK_SIZE", str(64 * 1024)))
+DOWNLOAD_TIMEOUT = float(os.environ.get("DOWNLOAD_TIMEOUT", "30"))
+# عمليات ffmpeg (الدمج وتحويل الصوت): عدد محدود يعمل معاً والباقي في طابور محدود
+FFMPEG_PATH = os.environ.get("FFMPEG_PATH") or shutil.which("ffmpeg") or "ffmpeg"
+FFMPEG_WORKERS = int(os.environ.get("FFMPEG_WORKERS", "4"))
+FFMPEG_MAX_QUEUE = int(os.environ.get("FFMPEG_MAX_QUEUE", "16"))
+FFMPEG_MAX_QUEUE_WAIT = float(os.environ.get("FFMPEG_MAX_QUEUE_WAIT", "10"))
+# أقصى وقت معالج (بالثواني) لكل عملية ffmpeg؛ بعده يوقفها النظام (RLIMIT_CPU)
+FFMPEG_CPU_LIMIT = int(os.environ.get("FFMPEG_CPU_LIMIT", "300"))
+
+# إعدادات عميل HTTP المشترك لكل الطلبات الصادرة (googlevideo و i.ytimg.com ...)
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "200"))
+HTTP_MAX_KEEPALIVE = int(os.environ.get("HTTP_MAX_KEEPALIVE", "50"))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", "30"))
+# أقصى عدد تحويلات متزامنة من نفس المضيف (0 = بلا حد غير حدود مجمع الاتصالات)، ومدة انتظار مكان
+# قبل الرد بـ 503: التحويل يحجز مكانه طوال البث، فلا ننتظر بلا نهاية انتهاء تحميل بحجم عدة GB
+HTTP_MAX_PER_HOST = int(os.environ.get("HTTP_MAX_PER_HOST", "32"))
+HTTP_HOST_WAIT = float(os.environ.get("HTTP_HOST_WAIT", "5"))
+# لا نجلب من عناوين داخلية (localhost، الشبكات الخاصة ...) إلا إذا سُمح بذلك صراحة (للتطوير فقط)
+UPSTREAM_ALLOW_PRIVATE = os.environ.get("UPSTREAM_ALLOW_PRIVATE", "0") == "1"
+
+# ضغط استجابات JSON حسب Accept-Encoding (لا نضغط الاستجابات الصغيرة)
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.environ.get("BROTLI_QUALITY", "5"))
+# أقصى عدد لنسخ الاستجابة المرمزة المحفوظة لكل فيديو (مجموعات fields/include/المرشحات × الترميز)
+ENCODED_VARIANTS_MAX = int(os.environ.get("ENCODED_VARIANTS_MAX", "8"))
+
+# حدود طلبات الدفعات في /extract-videos
+BATCH_MAX_URLS = int(os.environ.get("BATCH_MAX_URLS", "100"))
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "8"))
+
+# قوائم التشغيل والقنوات تُعرض على صفحات من عناصر مسطحة (معرف وعنوان فقط)
+PLAYLIST_PAGE_SIZE = int(os.environ.get("PLAYLIST_PAGE_SIZE", "50"))
+PLAYLIST_PAGE_MAX = int(os.environ.get("PLAYLIST_PAGE_MAX", "200"))
+PLAYLIST_CACHE_TTL = float(os.environ.get("PLAYLIST_CACHE_TTL", "600"))
+
+# مهام التحميل غير المتزامنة (/jobs): الطابور في SQLite والملفات الناتجة في JOBS_DIR
+JOBS_DIR = os.environ.get("JOBS_DIR", os.path.join(tempfile.gettempdir(), "snapload-jobs"))
+JOBS_DB = os.environ.get("JOBS_DB", os.path.join(JOBS_DIR, "jobs.sqlite3"))
+JOBS_WORKERS = int(os.environ.get("JOBS_WORKERS", "2"))
+JOBS_MAX_QUEUED = int(os.environ.get("JOBS_MAX_QUEUED", "100"))
+# مدة بقاء الملفات الناتجة بعد انتهاء المهمة
+JOBS_RESULT_TTL = float(os.environ.get("JOBS_RESULT_TTL", "86400"))
+# أقل فاصل بين كتابتين للتقدم في قاعدة البيانات، وفاصل فحص الطابور (لمهام العمليات الأخرى)
+JOBS_PROGRESS_INTERVAL = float(os.environ.get("JOBS_PROGRESS_INTERVAL", "1"))
+JOBS_POLL_INTERVAL = float(os.environ.get("JOBS_POLL_INTERVAL", "5"))
+
+# بث التقدم (SSE و WebSocket): أقل فاصل بين رسالتين لكل اتصال، وما بينهما يُدمج في آخر حالة
+PROGRESS_MIN_INTERVAL = float(os.environ.get("PROGRESS_MIN_INTERVAL", "0.25"))
+PROGRESS_PING_INTERVAL = float(os.environ.get("PROGRESS_PING_INTERVAL", "15"))
+
+YDL_OPTS = {
+    "format": "best",
+    "quiet": True,
+    "no_warnings": True,
+    # لا نحل عناصر قوائم التشغيل أبداً: نكتفي بالمعرف والعنوان ونجلبها عند الطلب فقط
+    "noplaylist": True,
+    "extract_flat": "in_playlist",
+    "lazy_playlist": True,
+    # لو عندك ملف cookies استخدمه هكذا:
+    # "cookiefile": "cookies.txt",
+}
+
+
+# مقاييس Prometheus
+REQUESTS = Counter("snapload_requests_total", "HTTP requests", ["method", "path", "status"])
+ERRORS = Counter("snapload_errors_total", "Failed extractions by exception type", ["exception"])
+CACHE_LOOKUPS = Counter("snapload_cache_lookups_total", "Metadata cache lookups", ["result"])
+# الروابط غير المصنفة لها قاطع لكل مضيف، وتُعد كلها تحت extractor="generic"
+BREAKER_OPEN = Gauge("snapload_circuit_open", "Open circuit breakers per extractor", ["extractor"])
+INFLIGHT = Gauge("snapload_extractions_inflight", "Extractions currently running", multiprocess_mode="livesum")
+QUEUED = Gauge("snapload_extractions_queued", "Extractions waiting for a worker", multiprocess_mode="livesum")
+QUEUE_WAIT = Histogram("snapload_queue_wait_seconds", "Time spent waiting for an extraction worker")
+STAGE_SECONDS = Histogram(
+    "snapload_stage_seconds",
+    "Latency of each /extract-video stage",
+    ["stage"],  # classify, cache_lookup, extract_info, format_trim, format_filter, format_select, response_encode
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+
+
+class MetricsMiddleware:
+    # يعد الطلبات حسب المسار (قالب المسار وليس الرابط الفعلي) وحالة الاستجابة
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            REQUESTS.labels(scope["method"], path, str(status)).inc()
+
+
+app.add_middleware(MetricsMiddleware)
+
+
 # موديل البيانات المتوقعة من الواجهة
 class VideoRequest(BaseModel):
     url: HttpUrl  # يتأكد أن الرابط URL صالح
 
+
+class BatchRequest(BaseModel):
+    urls: List[HttpUrl]
+
+
+class PlaylistRequest(BaseModel):
+    url: HttpUrl
+    offset: int = 0
+    limit: int = PLAYLIST_PAGE_SIZE
+
+
+class JobRequest(BaseModel):
+    url: HttpUrl
+    format: str = "bv*+ba/b"  # صيغة yt-dlp
+    audio: Optional[str] = None  # mp3 أو opus أو m4a: تحويل الناتج إلى صوت فقط
+    bitrate: Optional[int] = None
+    priority: str = "normal"
+
+
+class ClientLimits(BaseModel):
+    rate: float  # عمليات استخراج في الثانية
+    burst: float
+    weight: float = 1.0  # حصة العميل في كل دورة من الجدولة العادلة
+
+
+class RateLimits(ClientLimits):
+    # الحدود الافتراضية لكل IP، وحدود خاصة لمفاتيح API معروفة
+    keys: Dict[str, ClientLimits] = {}
+
+
+class Format(NamedTuple):
+    # سجل صيغة مضغوط: tuple بلا __dict__ بدل dict لكل صيغة، ويتحول إلى JSON كقائمة
+    format_id: str
+    ext: Optional[str]
+    resolution: Optional[str]
+    height: Optional[int]
+    width: Optional[int]
+    fps: Optional[float]
+    vcodec: Optional[str]
+    acodec: Optional[str]
+    tbr: Optional[float]
+    abr: Optional[float]
+    filesize: Optional[int]
+    url: Optional[str]
+    expires_at: Optional[int]
+
+
+# الحقول التي تعود افتراضياً (كما كانت قبل إضافة include)
+DEFAULT_FORMAT_FIELDS = ("format_id", "ext", "resolution", "filesize", "url", "expires_at")
+RESPONSE_FIELDS = ("title", "thumbnail", "duration", "formats", "expires_at")
+FORMAT_KINDS = ("video", "audio", "muxed")
+
+
+def _format_kind(f):
+    # video: صورة فقط، audio: صوت فقط، muxed: الاثنان معاً (أو غير معروف)
+    if f.vcodec == "none":
+        return "audio"
+    if f.acodec == "none":
+        return "video"
+    return "muxed"
+
+
+class ExtractionError(Exception):
+    # خطأ بسيط قابل للـ pickle حتى يعبر حدود العمليات في وضع process
+    # kind هو اسم نوع الاستثناء الأصلي (DownloadError، ExtractorError ...)
+    def __init__(self, message, kind="Exception"):
+        super().__init__(message, kind)
+        self.kind = kind
+
+    def __str__(self):
+        return self.args[0]
+
+
+# أخطاء دائمة تخص الفيديو نفسه وليس عطلاً في المصدر، فلا تُحسب على قاطع الدائرة
+_PERMANENT_ERRORS = (
+    ("private", ("private video",)),
+    ("unavailable", ("video unavailable", "has been removed", "no longer available", "does not exist")),
+    ("geo", ("not available in your country", "not available from your location", "geo restrict")),
+    ("age", ("confirm your age", "age-restricted")),
+    ("unsupported", ("unsupported url",)),
+)
+
+
+def _error_category(error):
+    message = str(error).lower()
+    for category, needles in _PERMANENT_ERRORS:
+        if any(needle in message for needle in needles):
+            return category
+    return None
+
+
+# أخطاء الاتصال بمضيف أرسله العميل (اسم لا يُحل، منفذ مغلق ...) تخص الرابط وليس المستخرج
+_CONNECT_ERRORS = (
+    "name or service not known", "nodename nor servname", "temporary failure in name resolution",
+    "failed to resolve", "getaddrinfo failed", "no address associated", "connection refused",
+    "no route to host", "network is unreachable",
+)
+
+
+def _upstream_failure(error, category, ie_key):
+    # هل يُحسب الخطأ على قاطع الدائرة؟ الأخطاء الدائمة وأخطاء العميل لا تُحسب
+    if category is not None or error.kind == "PlaylistURL":
+        return False
+    if ie_key is None:
+        message = str(error).lower()
+        return not any(needle in message for needle in _CONNECT_ERRORS)
+    return True
+
+
+# الصنف المستخدم للاستخراج؛ bench.py يستبدله بمستخرج وهمي يعمل بدون إنترنت
+YDL_CLASS = yt_dlp.YoutubeDL
+
+# نسخة YoutubeDL جاهزة لكل خيط (ولكل عملية في وضع process) بدلاً من إنشائها مع كل طلب
+_local = threading.local()
+
+
+def _get_ydl():
+    ydl = getattr(_local, "ydl", None)
+    if ydl is None:
+        ydl = _local.ydl = YDL_CLASS(YDL_OPTS)
+    return ydl
+
+
+def _discard_ydl():
+    ydl = getattr(_local, "ydl", None)
+    _local.ydl = None
+    if ydl is not None:
+        ydl.close()
+
+
+# خيارات تُضبط لطلب واحد فقط ويجب حذفها قبل إعادة استخدام النسخة
+_PER_CALL_PARAMS = ("playlist_items",)
+
+
+def _reset_ydl(ydl):
+    # نمسح العدادات والحالة الخاصة بالطلب السابق، ونُبقي المستخرجات وذاكرتها المؤقتة دافئة
+    for name in _PER_CALL_PARAMS:
+        ydl.params.pop(name, None)
+    ydl._num_downloads = 0
+    ydl._num_videos = 0
+    ydl._download_retcode = 0
+    ydl._playlist_level = 0
+    ydl._playlist_urls.clear()
+    ydl._printed_messages.clear()
+
+
+# روابط يوتيوب الشائعة: watch و youtu.be و shorts و embed (و live)
+_YOUTUBE_RE = re.compile(
+    r"^https?://(?:(?:www|m|music)\.)?"
+    r"(?:youtube\.com/(?:watch\?(?:[^#]*&)?v=|shorts/|embed/|live/)"
+    r"|youtube-nocookie\.com/embed/"
+    r"|youtu\.be/)"
+    r"([0-9A-Za-z_-]{11})(?![0-9A-Za-z_-])"
+)
+
+
+def classify_url(url):
+    # يعيد (مفتاح الذاكرة، الرابط الموحد، مفتاح المستخرج)
+    # لروابط يوتيوب نعرف المعرف مسبقاً ونتجاوز البحث في قائمة المستخرجات كاملة
+    m = _YOUTUBE_RE.match(url)
+    if m:
+        video_id = m.group(1)
+        return ("Youtube", video_id), "https://www.youtube.com/watch?v=" + video_id, "Youtube"
+    return None, url, None
+
+
+def _extract(url, ie_key=None):
+    # تعمل داخل مجمع الخيوط/العمليات، لذلك يجب أن تبقى دالة على مستوى الوحدة
+    ydl = _get_ydl()
+    started = time.perf_counter()
+    try:
+        info = ydl.extract_info(url, download=False, ie_key=ie_key)
+    except yt_dlp.utils.YoutubeDLError as e:
+        raise ExtractionError(str(e), type(e).__name__) from None
+    except Exception as e:
+        # خطأ غير متوقع قد يترك النسخة في حالة غير سليمة، لذلك نتخلص منها
+        _discard_ydl()
+        raise ExtractionError(str(e), type(e).__name__) from None
+    finally:
+        if getattr(_local, "ydl", None) is ydl:
+            _reset_ydl(ydl)
+    extracted = time.perf_counter()
+
+    if info.get("_type") == "playlist":
+        raise ExtractionError("This URL is a playlist or channel, use /extract-playlist", "PlaylistURL")
+
+    # أعد فقط البيانات التي تحتاجها للواجهة (مثل العنوان، الوصف، والصيغ المتاحة)
+    # مع حذف صيغ storyboard (صور مصغرة وليست فيديو) والصيغ المكررة
+    formats = []
+    seen = set()
+    for f in info.get("formats", []):
+        format_id = f.get("format_id")
+        if format_id in seen or f.get("ext") == "mhtml" or f.get("protocol") == "mhtml":
+            continue
+        seen.add(format_id)
+        formats.append(Format(
+            format_id=format_id,
+            ext=f.get("ext"),
+            resolution=f.get("resolution") or f.get("height"),
+            height=f.get("height"),
+            width=f.get("width"),
+            fps=f.get("fps"),
+            vcodec=f.get("vcodec"),
+            acodec=f.get("acodec"),
+            tbr=f.get("tbr"),
+            abr=f.get("abr"),
+            filesize=f.get("filesize"),
+            url=f.get("url"),
+            expires_at=_url_expiry(f.get("url")),
+        ))
+
+    key = (info.get("extractor_key"), info.get("id"))
+    data = {
+        "title": info.get("title"),
+        "thumbnail": info.get("thumbnail"),
+        "duration": info.get("duration"),
+        "formats": formats,
+        "expires_at": _earliest_expiry(formats),
+    }
+    # المقاييس تُسجل في العملية الرئيسية، لذلك نعيد التوقيتات مع النتيجة
+    timings = {"extract_info": extracted - started, "format_trim": time.perf_counter() - extracted}
+    return key, data, timings
+
+
+def _extract_playlist(url, start, end):
+    # عناصر الصفحة المطلوبة فقط (playlist_items)؛ lazy_playlist يمنع جلب باقي الصفحات
+    ydl = _get_ydl()
+    ydl.params["playlist_items"] = f"{start}-{end}"
+    try:
+        info = ydl.extract_info(url, download=False)
+    except yt_dlp.utils.YoutubeDLError as e:
+        raise ExtractionError(str(e), type(e).__name__) from None
+    except Exception as e:
+        _discard_ydl()
+        raise ExtractionError(str(e), type(e).__name__) from None
+    finally:
+        if getattr(_local, "ydl", None) is ydl:
+            _reset_ydl(ydl)
+
+    if info.get("_type") != "playlist":
+        raise ExtractionError("This URL is a single video, use /extract-video", "VideoURL")
+
+    entries = []
+    for index, entry in enumerate(info.get("entries") or [], start=start):
+        if not entry:
+            continue
+        entries.append({
+            "index": index,
+            "id": entry.get("id"),
+            "title": entry.get("title"),
+            "duration": entry.get("duration"),
+            "url": entry.get("url") or entry.get("webpage_url"),
+        })
+
+    return {
+        "id": info.get("id"),
+        "title": info.get("title"),
+        "extractor": info.get("extractor_key"),
+        "count": info.get("playlist_count"),
+        "entries": entries,
+    }
+
+
+# روابط googlevideo تحمل وقت انتهاء الصلاحية إما كـ ?expire=... أو /expire/.../
+_EXPIRE_RE = re.compile(r"[?&/]expire[=/](\d+)")
+
+
+def _url_expiry(url):
+    m = _EXPIRE_RE.search(url or "")
+    return int(m.group(1)) if m else None
+
+
+def _earliest_expiry(formats):
+    expiries = [f.expires_at for f in formats if f.expires_at is not None]
+    return min(expiries) if expiries else None
+
+
+def _soft_ttl(ttl):
+    # العمر "الطازج" قبل أن يصبح العنصر قابلاً للتجديد، ولا يقل عن نصف العمر الكلي
+    return max(ttl - CACHE_STALE_WINDOW, ttl / 2)
+
+
+def _cache_ttl(data):
+    # عمر العنصر في الذاكرة لا يتجاوز أقرب انتهاء لرابط من روابطه (مع هامش أمان)
+    ttl = CACHE_TTL
+    expire = data.get("expires_at")
+    if expire is not None:
+        ttl = min(ttl, expire - time.time() - CACHE_EXPIRY_MARGIN)
+    return ttl
+
+
+class TTLCache:
+    # ذاكرة LRU بسيطة داخل العملية، لكل عنصر وقت انتهاء خاص به
+    # source اختياري: الرابط الذي أنتج العنصر، يُحفظ معه حتى يعيش ويُطرد معه
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+
+    def get(self, key):
+        return self.lookup(key)[0]
+
+    def lookup(self, key):
+        # يعيد (القيمة، هل ما زالت طازجة)؛ بين العمر الطازج والعمر الكلي تعود القيمة مع False
+        item = self._data.get(key)
+        if item is None:
+            return None, False
+        value, expires, hits, soft_expires, _ = item
+        now = time.time()
+        if expires <= now:
+            del self._data[key]
+            return None, False
+        item[2] = hits + 1
+        self._data.move_to_end(key)
+        return value, now < soft_expires
+
+    def set(self, key, value, ttl, soft_ttl=None, source=None):
+        if ttl <= 0:
+            return
+        now = time.time()
+        self._data[key] = [value, now + ttl, 0, now + (ttl if soft_ttl is None else soft_ttl), source]
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def hot(self, within, min_hits):
+        # (المفتاح، الرابط) للعناصر المطلوبة كثيراً والتي ستنتهي خلال within ثانية
+        deadline = time.time() + within
+        return [
+            (key, source) for key, (_, expires, hits, _, source) in self._data.items()
+            if expires <= deadline and hits >= min_hits and source is not None
+        ]
+
+
+class DiskCache:
+    # ذاكرة مشتركة بين العمليات: كل عملية تفتح اتصالها الخاص، وSQLite يتولى القفل بينها
+    EVICT_EVERY = 64  # نفحص الحجم الكلي مرة كل عدد من عمليات الكتابة
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._writes = 0
+
+    def _connection(self):
+        # الاتصال لا يُورث عبر fork، لذلك نعيد فتحه إذا تغيرت العملية
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL,"
+                " size INTEGER NOT NULL, accessed REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def get(self, key):
+        # يعيد (القيمة، الوقت المتبقي) أو None
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute("SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] <= now:
+                conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+        return _loads(row[0]), row[1] - now
+
+    def set(self, key, value, ttl):
+        if ttl <= 0:
+            return
+        now = time.time()
+        blob = _dumps(value).decode()
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires, size, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, blob, now + ttl, len(blob), now),
+            )
+            self._writes += 1
+            if self._writes % self.EVICT_EVERY == 0:
+                self._evict(conn, now)
+
+    def _evict(self, conn, now):
+        # نحذف المنتهية أولاً، ثم الأقدم استخداماً حتى نعود تحت الحد
+        conn.execute("DELETE FROM cache WHERE expires <= ?", (now,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        freed = 0
+        doomed = []
+        for key, size in conn.execute("SELECT key, size FROM cache ORDER BY accessed"):
+            doomed.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        conn.executemany("DELETE FROM cache WHERE key = ?", doomed)
+
+
+def _disk_key(key):
+    return f"video:{key[0]}:{key[1]}"
+
+
+class CircuitBreaker:
+    # closed -> open عند ارتفاع نسبة الأخطاء، ثم half-open بعد فترة التهدئة لتجربة طلب واحد
+    def __init__(self, name, label=None):
+        self.name = name
+        self.label = label or name  # اسم المستخرج في المقاييس
+        self._events = deque()  # (الوقت، هل فشل)
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    def check(self):
+        # يرفع 503 فوراً بدل شغل عامل استخراج بطلب محكوم عليه بالفشل
+        # يعيد True إذا كان هذا الطلب هو طلب التجربة في حالة half-open
+        if self._opened_at is None:
+            return False
+        remaining = self._opened_at + BREAKER_COOLDOWN - time.monotonic()
+        if remaining > 0 or self._trial:
+            raise HTTPException(
+                status_code=503,
+                detail=f"{self.name} extraction is temporarily failing, please retry later",
+                headers={"Retry-After": str(max(1, int(remaining + 0.999)))},
+            )
+        self._trial = True
+        return True
+
+    def discard(self):
+        # عند طرد القاطع من الذاكرة
+        if self._opened_at is not None:
+            BREAKER_OPEN.labels(self.label).dec()
+
+    def abandon(self):
+        # طلب التجربة لم يصل إلى الاستخراج (429، 503، مهلة، انقطاع العميل): الطلب التالي يجرب بدلاً منه
+        self._trial = False
+
+    def record(self, failed):
+        now = time.monotonic()
+        if self._opened_at is not None:
+            if not self._trial:
+                return  # نتيجة طلب بدأ قبل فتح القاطع
+            self._trial = False
+            if failed:
+                self._opened_at = now
+                return
+            self._opened_at = None
+            self._events.clear()
+            self._failures = 0
+            BREAKER_OPEN.labels(self.label).dec()
+            return
+
+        self._events.append((now, failed))
+        self._failures += failed
+        while self._events and self._events[0][0] < now - BREAKER_WINDOW:
+            self._failures -= self._events.popleft()[1]
+        total = len(self._events)
+        if total >= BREAKER_MIN_CALLS and self._failures / total >= BREAKER_ERROR_RATE:
+            self._opened_at = now
+            BREAKER_OPEN.labels(self.label).inc()
+
+
+def _make_executor():
+    if EXTRACT_POOL == "process":
+        return ProcessPoolExecutor(max_workers=EXTRACT_WORKERS)
+    return ThreadPoolExecutor(max_workers=EXTRACT_WORKERS, thread_name_prefix="extract")
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        # يعيد 0 إذا سُمح بالطلب، وإلا عدد الثواني حتى يتوفر رمز جديد
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        if self.rate <= 0:
+            return 60.0
+        return (1 - self.tokens) / self.rate
+
+    def idle(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class RateLimiter:
+    # token bucket لكل عميل؛ الحدود نفسها قابلة للتغيير أثناء التشغيل
+    MAX_BUCKETS = 10000
+
+    def __init__(self, limits):
+        self.limits = limits
+        self._buckets = {}
+
+    def configure(self, limits):
+        self.limits = limits
+        self._buckets.clear()
+
+    def client_limits(self, client):
+        if client.startswith("key:"):
+            return self.limits.keys.get(client[4:], self.limits)
+        return self.limits
+
+    def check(self, client):
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            if len(self._buckets) >= self.MAX_BUCKETS:
+                # العملاء الخاملون (دلوهم ممتلئ) لا حاجة لتذكرهم
+                now = time.monotonic()
+                self._buckets = {c: b for c, b in self._buckets.items() if not b.idle(now)}
+            limits = self.client_limits(client)
+            bucket = self._buckets[client] = TokenBucket(limits.rate, limits.burst)
+        retry_after = bucket.take()
+        if retry_after:
+            raise HTTPException(
+                status_code=429,
+                detail="Rate limit exceeded",
+                headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+            )
+
+    def weight(self, client):
+        if client is None:
+            return 1.0
+        return self.client_limits(client).weight
+
+
+class FairQueue:
+    # جدولة عادلة (deficit round-robin) بين العملاء على أماكن المجمع المحدودة:
+    # عميل واحد بمئة طلب في الطابور لا يؤخر عميلاً آخر بطلب واحد أكثر من دورة واحدة
+    def __init__(self, slots, weight):
+        self.free = slots
+        self.waiting = 0
+        self._weight = weight
+        self._queues = OrderedDict()  # client -> deque من futures
+        self._deficit = {}
+
+    def locked(self):
+        return self.free <= 0 or bool(self._queues)
+
+    async def acquire(self, client):
+        if not self.locked():
+            self.free -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(client)
+        if queue is None:
+            queue = self._queues[client] = deque()
+            self._deficit[client] = 0.0
+        queue.append(future)
+        self.waiting += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # حصلنا على المكان في نفس لحظة الإلغاء، فنمرره للتالي
+                self.release()
+            else:
+                self._remove(client, future)
+            raise
+        finally:
+            self.waiting -= 1
+
+    def release(self):
+        self.free += 1
+        self._dispatch()
+
+    def _remove(self, client, future):
+        queue = self._queues.get(client)
+        if queue is None:
+            return
+        try:
+            queue.remove(future)
+        except ValueError:
+            return
+        if not queue:
+            del self._queues[client]
+            del self._deficit[client]
+
+    def _dispatch(self):
+        while self.free > 0 and self._queues:
+            client, queue = next(iter(self._queues.items()))
+            if self._deficit[client] < 1:
+                # انتهت حصة هذا العميل في الدورة الحالية: نضيف حصته التالية وننتقل للعميل التالي
+                self._deficit[client] += max(self._weight(client), 0.01)
+                self._queues.move_to_end(client)
+                continue
+            future = queue.popleft()
+            if not queue:
+                del self._queues[client]
+                del self._deficit[client]
+            if future.done():
+                # منتظر أُلغي ولم يحذفه _remove بعد (يعمل في دورة لاحقة): نتجاوزه دون أن نخصم مكاناً أو حصة
+                continue
+            if client in self._deficit:
+                self._deficit[client] -= 1
+            self.free -= 1
+            future.set_result(None)
+
+
+def _overloaded(detail, retry_after):
+    return HTTPException(
+        status_code=503,
+        detail=detail,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+class ExtractionGate:
+    # يحد عدد عمليات الاستخراج الجارية ويضع الباقي في طابور انتظار محدود
+    def __init__(self, executor, max_inflight, max_queue, max_wait):
+        self.executor = executor
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.inflight = 0
+        self.waiting = 0
+        # متوسط متحرك (EWMA) لمدة الاستخراج، نستخدمه لتقدير زمن الانتظار
+        self.service_time = EXTRACT_SERVICE_ESTIMATE
+        self._queue = FairQueue(max_inflight, limiter.weight)
+
+    def estimated_wait(self):
+        if not self._queue.locked():
+            return 0.0
+        return (self.waiting + 1) * self.service_time / self.max_inflight
+
+    async def run(self, fn, *args, deadline=None, client=None, on_start=None):
+        # deadline بتوقيت time.monotonic(): إذا لم يبدأ العمل قبله نتخلى عنه
+        # client هو هوية العميل للحد من المعدل والجدولة العادلة (None لأعمال الخلفية)
+        if client is not None:
+            limiter.check(client)
+        wait = self.estimated_wait()
+        if self._queue.locked() and self.waiting >= self.max_queue:
+            raise _overloaded("Server is busy, please retry later", wait)
+        if wait > self.max_wait:
+            raise _overloaded("Server is busy, please retry later", wait - self.max_wait)
+        if deadline is not None and time.monotonic() + wait > deadline:
+            raise _overloaded("Server is busy, the request would not finish in time", wait)
+
+        self.waiting += 1
+        QUEUED.inc()
+        queued_at = time.perf_counter()
+        try:
+            async with asyncio.timeout(None if deadline is None else deadline - time.monotonic()):
+                await self._queue.acquire(client)
+        except TimeoutError:
+            raise _overloaded("Request expired while waiting in the queue", self.estimated_wait()) from None
+        finally:
+            self.waiting -= 1
+            QUEUED.dec()
+        QUEUE_WAIT.observe(time.perf_counter() - queued_at)
+        if on_start is not None:
+            on_start()
+
+        self.inflight += 1
+        INFLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            future = asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        except BaseException:
+            self._finished(started, None)
+            raise
+        # الخيط لا يمكن إيقافه بعد أن يبدأ: إذا أُلغي الطلب نترك العمل يكمل
+        # ولا نحرر مكانه في المجمع إلا عند انتهائه فعلاً
+        future.add_done_callback(lambda f: self._finished(started, f))
+        return await asyncio.shield(future)
+
+    def _finished(self, started, future):
+        self.service_time += 0.2 * (time.perf_counter() - started - self.service_time)
+        self.inflight -= 1
+        INFLIGHT.dec()
+        self._queue.release()
+        if future is not None and not future.cancelled():
+            future.exception()  # نعتبر الخطأ مقروءاً حتى لو لم يعد أحد ينتظره
+
+
+class SingleFlight:
+    # الطلبات المتزامنة لنفس المفتاح تنتظر عملية واحدة مشتركة وتستلم نتيجتها أو خطأها
+    def __init__(self):
+        self._flights = {}  # key -> [task, عدد المنتظرين]
+
+    async def do(self, key, fn):
+        flight = self._flights.get(key)
+        if flight is None:
+            task = asyncio.ensure_future(fn())
+            flight = self._flights[key] = [task, 0]
+            task.add_done_callback(lambda t: self._done(key, t))
+        task = flight[0]
+        flight[1] += 1
+        try:
+            # shield حتى لا يُلغى الاستخراج المشترك إذا انسحب أحد المنتظرين
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # انسحب هذا المنتظر (انقطع العميل أو انتهت مهلته)؛ إذا لم يبق غيره نلغي العمل المشترك
+            if flight[1] == 1 and not task.done():
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                task.cancel()
+            raise
+        finally:
+            flight[1] -= 1
+
+    def pending(self, key):
+        return key in self._flights
+
+    def _done(self, key, task):
+        flight = self._flights.get(key)
+        if flight is not None and flight[0] is task:
+            del self._flights[key]
+        if not task.cancelled():
+            task.exception()  # نعتبر الخطأ مقروءاً حتى لو لم يبق أحد ينتظره
+
+
+class ProgressSubscriber:
+    # انتقالات المراحل تُرسل كلها بالترتيب، أما تحديثات نفس المرحلة فتُدمج في آخر قيمة فقط
+    def __init__(self):
+        self.transitions = deque(maxlen=32)
+        self.latest = None
+        self.stage = None
+        self.event = asyncio.Event()
+
+    def push(self, message):
+        if message.get("stage") != self.stage:
+            self.stage = message.get("stage")
+            self.transitions.append(message)
+            self.latest = None
+        else:
+            self.latest = message
+        self.event.set()
+
+    async def next(self, timeout):
+        # يعيد الرسائل المتراكمة منذ آخر استدعاء، أو قائمة فارغة بعد timeout
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except TimeoutError:
+            return []
+        self.event.clear()
+        messages = list(self.transitions)
+        self.transitions.clear()
+        if self.latest is not None:
+            messages.append(self.latest)
+            self.latest = None
+        return messages
+
+
+class ProgressHub:
+    # نشر واشتراك داخل العملية لأحداث التقدم حسب الموضوع (job:<id> أو extract:<url>)
+    def __init__(self):
+        self.loop = None
+        self._topics = {}
+        self._last = TTLCache(CACHE_MAX_ENTRIES)  # آخر حالة لكل موضوع للمشتركين المتأخرين
+
+    def publish(self, topic, message):
+        self._last.set(topic, message, 60)
+        for subscriber in self._topics.get(topic, ()):
+            subscriber.push(message)
+
+    def publish_threadsafe(self, topic, message):
+        # من خيوط العمل (خطافات yt-dlp) إلى حلقة الأحداث
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.publish, topic, message)
+
+    def last(self, topic):
+        return self._last.get(topic)
+
+    def subscribe(self, topic):
+        subscriber = ProgressSubscriber()
+        self._topics.setdefault(topic, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, topic, subscriber):
+        subscribers = self._topics.get(topic)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._topics[topic]
+
+
+class FFmpegPool:
+    # يحد عدد عمليات ffmpeg الجارية؛ الباقي ينتظر دوره في طابور عادل محدود الطول والمدة
+    def __init__(self, workers, max_queue, max_wait):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.waiting = 0
+        self._queue = FairQueue(workers, limiter.weight)
+
+    async def acquire(self, client=None):
+        if self._queue.locked() and self.waiting >= self.max_queue:
+            raise _overloaded("Too many conversions in progress, please retry later", self.max_wait)
+        self.waiting += 1
+        try:
+            async with asyncio.timeout(self.max_wait):
+                await self._queue.acquire(client)
+        except TimeoutError:
+            raise _overloaded("Conversion did not start in time, please retry later", self.max_wait) from None
+        finally:
+            self.waiting -= 1
+
+    def release(self):
+        self._queue.release()
+
+
+def _require_public(addresses):
+    # روابط الصيغ تأتي من المستخرج العام وقد تشير إلى أي مضيف، فنرفض العناوين غير العامة
+    # حتى لا يصبح الخادم proxy للشبكة الداخلية
+    for address in addresses:
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        if not address.is_global:
+            raise HTTPException(status_code=403, detail="Refusing to fetch from a non-public address")
+
+
+def _info_addresses(infos):
+    return list(dict.fromkeys(ipaddress.ip_address(info[4][0].split("%")[0]) for info in infos))
+
+
+def _require_public_url(url):
+    # النسخة المتزامنة لخيوط yt-dlp (مهام /jobs)، حيث لا نتحكم في الاتصال نفسه فنفحص الرابط قبله
+    if UPSTREAM_ALLOW_PRIVATE or not url:
+        return
+    host = httpx.URL(url).host
+    try:
+        addresses = [ipaddress.ip_address(host)]
+    except ValueError:
+        try:
+            addresses = _info_addresses(socket.getaddrinfo(host, None, type=socket.SOCK_STREAM))
+        except socket.gaierror:
+            return  # يفشل الاتصال نفسه لاحقاً
+    _require_public(addresses)
+
+
+class PublicNetworkBackend(httpcore.AsyncNetworkBackend):
+    # يحل اسم المضيف مرة واحدة ويتصل بالعنوان الذي فحصه نفسه، فلا يستطيع DNS قصير العمر
+    # أن يعيد عنواناً داخلياً بين الفحص والاتصال. SNI وترويسة Host يبقيان للاسم الأصلي
+    # لأن httpcore يأخذهما من الطلب وليس من connect_tcp. يعمل لكل اتصال، بما فيه كل تحويل (redirect)
+    def __init__(self, backend):
+        self._backend = backend
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        if UPSTREAM_ALLOW_PRIVATE:
+            return await self._backend.connect_tcp(host, port, timeout, local_address, socket_options)
+        try:
+            addresses = [ipaddress.ip_address(host)]
+        except ValueError:
+            try:
+                async with asyncio.timeout(timeout):
+                    infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+            except TimeoutError:
+                raise httpcore.ConnectTimeout(f"Resolving {host} timed out") from None
+            except socket.gaierror as e:
+                raise httpcore.ConnectError(str(e)) from None
+            addresses = _info_addresses(infos)
+        _require_public(addresses)
+        error = None
+        for address in addresses:
+            try:
+                return await self._backend.connect_tcp(str(address), port, timeout, local_address, socket_options)
+            except httpcore.ConnectError as e:
+                error = e
+        raise error
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        return await self._backend.connect_unix_socket(path, timeout, socket_options)
+
+    async def sleep(self, seconds):
+        await self._backend.sleep(seconds)
+
+
+class UpstreamClient:
+    # عميل httpx واحد باتصالات keep-alive معاد استخدامها، مع حد لعدد الطلبات لكل مضيف
+    def __init__(self, max_per_host):
+        self.max_per_host = max_per_host
+        self.client = None
+        self._hosts = {}  # host -> [semaphore, users]
+
+    async def start(self):
+        transport = httpx.AsyncHTTPTransport(
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+        )
+        # httpx 0.25 لا يعرض network_backend في AsyncHTTPTransport، فنلفه على مجمع httpcore مباشرة
+        transport._pool._network_backend = PublicNetworkBackend(transport._pool._network_backend)
+        self.client = httpx.AsyncClient(transport=transport, follow_redirects=True, timeout=DOWNLOAD_TIMEOUT)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    @asynccontextmanager
+    async def stream(self, url, headers=None):
+        if self.max_per_host <= 0:
+            async with self._open(url, headers) as resp:
+                yield resp
+            return
+        host = httpx.URL(url).host
+        slot = self._hosts.setdefault(host, [asyncio.Semaphore(self.max_per_host), 0])
+        slot[1] += 1
+        try:
+            try:
+                async with asyncio.timeout(HTTP_HOST_WAIT):
+                    await slot[0].acquire()
+            except TimeoutError:
+                raise _overloaded(f"Too many transfers from {host}, please retry later", HTTP_HOST_WAIT) from None
+            try:
+                async with self._open(url, headers) as resp:
+                    yield resp
+            finally:
+                slot[0].release()
+        finally:
+            slot[1] -= 1
+            if slot[1] == 0:
+                self._hosts.pop(host, None)
+
+    @asynccontextmanager
+    async def _open(self, url, headers):
+        # امتلاء مجمع الاتصالات نفسه (PoolTimeout) ضغط مؤقت وليس خطأ من المصدر
+        try:
+            async with self.client.stream("GET", url, headers=headers) as resp:
+                yield resp
+        except httpx.PoolTimeout:
+            raise _overloaded("Too many upstream connections, please retry later", DOWNLOAD_TIMEOUT) from None
+
+
+upstream = UpstreamClient(HTTP_MAX_PER_HOST)
+limiter = RateLimiter(RateLimits(rate=RATE_LIMIT_RATE, burst=RATE_LIMIT_BURST))
+gate = ExtractionGate(_make_executor(), EXTRACT_MAX_INFLIGHT, EXTRACT_MAX_QUEUE, EXTRACT_MAX_QUEUE_WAIT)
+ffmpeg_pool = FFmpegPool(FFMPEG_WORKERS, FFMPEG_MAX_QUEUE, FFMPEG_MAX_QUEUE_WAIT)
+hub = ProgressHub()
+# النتائج مخزنة حسب (المستخرج، معرف الفيديو)، والروابط تشير إلى هذا المفتاح
+metadata_cache = TTLCache(CACHE_MAX_ENTRIES)
+url_keys = TTLCache(CACHE_MAX_ENTRIES * 4)
+playlist_cache = TTLCache(CACHE_MAX_ENTRIES)
+negative_cache = TTLCache(CACHE_MAX_ENTRIES)
+breakers = OrderedDict()
+
+
+def _breaker(ie_key, url):
+    # قاطع لكل مستخرج معروف، ولكل مضيف في الروابط غير المصنفة حتى لا تعطل روابط معطوبة
+    # يرسلها عميل واحد الاستخراج لكل المواقع الأخرى
+    name = ie_key or httpx.URL(url).host
+    breaker = breakers.get(name)
+    if breaker is None:
+        breaker = breakers[name] = CircuitBreaker(name, ie_key or "generic")
+        while len(breakers) > CACHE_MAX_ENTRIES:
+            breakers.popitem(last=False)[1].discard()
+    breakers.move_to_end(name)
+    return breaker
+
+
+disk_cache = DiskCache(CACHE_DB, CACHE_DB_MAX_BYTES) if CACHE_DB else None
+
+
+async def _disk_lookup(video_url, key):
+    # يعيد (المفتاح، البيانات، هل هي طازجة) من ذاكرة القرص وينقلها إلى الذاكرة المحلية
+    if key is None:
+        hit = await asyncio.to_thread(disk_cache.get, "url:" + video_url)
+        if hit is None:
+            return None, None, False
+        key = tuple(hit[0])
+        url_keys.set(video_url, key, hit[1])
+
+    hit = await asyncio.to_thread(disk_cache.get, _disk_key(key))
+    if hit is None:
+        return key, None, False
+    data, ttl = hit
+    # الصيغ مخزنة كقوائم في JSON فنعيدها إلى Format
+    try:
+        data["formats"] = [Format(*f) for f in data["formats"]]
+    except TypeError:
+        return key, None, False  # صف بصيغة قديمة
+    # ttl هنا هو الوقت المتبقي، فنحسب العمر الطازج من نهاية العمر وليس من بدايته
+    soft_ttl = ttl - CACHE_STALE_WINDOW
+    metadata_cache.set(key, data, ttl, soft_ttl, source=video_url)
+    return key, data, soft_ttl > 0
+
+
+flights = SingleFlight()
+
+
+async def _get_video(video_url, deadline=None, client=None):
+    with STAGE_SECONDS.labels("classify").time():
+        key, target_url, ie_key = classify_url(video_url)
+
+    with STAGE_SECONDS.labels("cache_lookup").time():
+        failure = negative_cache.get(key or video_url)
+        if failure is not None:
+            CACHE_LOOKUPS.labels("negative").inc()
+            raise ExtractionError(*failure)
+        if key is None:
+            key = url_keys.get(video_url)
+        cached, fresh = metadata_cache.lookup(key) if key is not None else (None, False)
+        result = "hit"
+        if cached is None and disk_cache is not None:
+            key, cached, fresh = await _disk_lookup(video_url, key)
+            result = "disk_hit"
+    if cached is not None:
+        if not fresh:
+            # stale-while-revalidate: نعيد النسخة الحالية ونطلق تجديداً واحداً في الخلفية
+            result = "stale"
+            if not flights.pending(key):
+                _spawn(_refresh(key, video_url))
+        CACHE_LOOKUPS.labels(result).inc()
+        return cached
+    CACHE_LOOKUPS.labels("miss").inc()
+
+    # الطلب الذي يبدأ الاستخراج يفرض مهلته على الطابور؛ والمنتظرون معه يتوقفون عند مهلتهم
+    try:
+        async with asyncio.timeout(None if deadline is None else deadline - time.monotonic()):
+            return await flights.do(key or video_url, lambda: _fetch_video(video_url, target_url, ie_key, deadline, client))
+    except TimeoutError:
+        raise HTTPException(status_code=504, detail="Extraction did not finish in time") from None
+
+
+async def _fetch_video(video_url, target_url, ie_key, deadline=None, client=None):
+    breaker = _breaker(ie_key, target_url)
+    trial = breaker.check()
+    topic = "extract:" + target_url
+    hub.publish(topic, {"stage": "queued"})
+    # الاستخراج يتم خارج حلقة الأحداث حتى لا يحجب باقي الطلبات
+    try:
+        key, data, timings = await gate.run(
+            _extract, target_url, ie_key, deadline=deadline, client=client,
+            on_start=lambda: hub.publish(topic, {"stage": "extracting"}),
+        )
+    except ExtractionError as e:
+        hub.publish(topic, {"stage": "failed", "error": str(e)})
+        ERRORS.labels(e.kind).inc()
+        category = _error_category(e)
+        breaker.record(failed=_upstream_failure(e, category, ie_key))
+        if category is not None:
+            negative_cache.set(classify_url(video_url)[0] or video_url, e.args, NEGATIVE_TTL)
+        raise
+    except BaseException as e:
+        # لا نتيجة للاستخراج (رفض، مهلة، إلغاء ...) فلا نسجل شيئاً في القاطع، لكن نحرر طلب التجربة
+        hub.publish(topic, {"stage": "failed", "error": getattr(e, "detail", None) or str(e) or type(e).__name__})
+        if trial:
+            breaker.abandon()
+        raise
+    breaker.record(failed=False)
+    for stage, seconds in timings.items():
+        STAGE_SECONDS.labels(stage).observe(seconds)
+    ttl = _cache_ttl(data)
+    # الرابط الأصلي يُحفظ مع العنصر لنتمكن من إعادة الاستخراج عند التجديد في الخلفية
+    metadata_cache.set(key, data, ttl, _soft_ttl(ttl), source=video_url)
+    url_keys.set(video_url, key, ttl)
+    if disk_cache is not None:
+        await asyncio.to_thread(disk_cache.set, _disk_key(key), data, ttl)
+        if key != classify_url(video_url)[0]:
+            await asyncio.to_thread(disk_cache.set, "url:" + video_url, list(key), ttl)
+    hub.publish(topic, {"stage": "done"})
+    return data
+
+
+# نحتفظ بمراجع مهام الخلفية حتى لا يجمعها جامع القمامة قبل انتهائها
+_background_tasks = set()
+
+
+def _spawn(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def _refresh(key, video_url):
+    _, target_url, ie_key = classify_url(video_url)
+    try:
+        await flights.do(key, lambda: _fetch_video(video_url, target_url, ie_key))
+    except (ExtractionError, HTTPException):
+        # فشل التجديد ليس مشكلة: العنصر القديم يبقى صالحاً حتى نهاية عمره
+        pass
+
+
+async def _refresh_loop():
+    # نجدد العناصر الساخنة قبل موت روابطها حتى لا يعود الفيديو الشائع إلى الاستخراج البطيء
+    while True:
+        await asyncio.sleep(REFRESH_INTERVAL)
+        for key, video_url in metadata_cache.hot(REFRESH_AHEAD, REFRESH_MIN_HITS):
+            _spawn(_refresh(key, video_url))
+
+
+def _client_id(request):
+    # مفاتيح API المعروفة فقط لها حدود خاصة؛ غير ذلك نعرف العميل بعنوان IP
+    api_key = request.headers.get("x-api-key")
+    if api_key and api_key in limiter.limits.keys:
+        return "key:" + api_key
+    return "ip:" + _client_ip(request)
+
+
+def _client_ip(request):
+    # بدون TRUSTED_PROXY_HOPS خلف proxy يظهر كل العملاء بعنوان الـ proxy ويتشاركون حداً واحداً
+    if TRUSTED_PROXY_HOPS > 0:
+        hops = [h.strip() for h in ",".join(request.headers.getlist("x-forwarded-for")).split(",") if h.strip()]
+        if len(hops) >= TRUSTED_PROXY_HOPS:
+            return hops[-TRUSTED_PROXY_HOPS]
+    return request.client.host if request.client else "unknown"
+
+
+async def _until_disconnected(request, coro):
+    # ننفذ coro ما دام العميل متصلاً؛ إذا أغلق الصفحة نلغيه فيُحذف من الطابور
+    # (إلا إذا كان هناك منتظرون آخرون لنفس الاستخراج)
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                raise HTTPException(status_code=499, detail="Client disconnected")
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+def _split(value):
+    return [v.strip() for v in value.split(",") if v.strip()] if value else []
+
+
+def _select_formats(formats, kind=None, min_height=None, max_height=None, ext=None):
+    exts = set(_split(ext))
+    selected = []
+    for f in formats:
+        if kind is not None and _format_kind(f) != kind:
+            continue
+        if min_height is not None and (f.height or 0) < min_height:
+            continue
+        if max_height is not None and (f.height is None or f.height > max_height):
+            continue
+        if exts and f.ext not in exts:
+            continue
+        selected.append(f)
+    return selected
+
+
+def _view_fields(fields, include, kind):
+    # يتحقق من معاملات العرض ويعيد (fields، include) محللة؛ يُستدعى قبل الاستخراج أيضاً
+    # حتى لا يستهلك طلب خاطئ استخراجاً كاملاً ورصيداً من حد المعدل قبل رفضه
+    fields = _split(fields) or RESPONSE_FIELDS
+    include = _split(include) or DEFAULT_FORMAT_FIELDS
+    unknown = [f for f in fields if f not in RESPONSE_FIELDS] + [f for f in include if f not in Format._fields]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown field(s): {', '.join(unknown)}")
+    if kind is not None and kind not in FORMAT_KINDS:
+        raise HTTPException(status_code=400, detail=f"kind must be one of {', '.join(FORMAT_KINDS)}")
+    return fields, include
+
+
+def _render(data, fields=None, include=None, **filters):
+    # يبني استجابة JSON من البيانات المخزنة: الحقول المطلوبة فقط والصيغ المطابقة للمرشحات
+    fields, include = _view_fields(fields, include, filters.get("kind"))
+    out = {}
+    for name in fields:
+        if name == "formats":
+            formats = _select_formats(data["formats"], **filters)
+            out["formats"] = [{field: getattr(f, field) for field in include} for f in formats]
+        else:
+            out[name] = data.get(name)
+    return out
+
+
+def _negotiate_encoding(accept_encoding):
+    accepted = {part.split(";")[0].strip().lower() for part in (accept_encoding or "").split(",")}
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def _compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+# البايتات المرمزة (والمضغوطة) لكل نتيجة مخزنة، حتى لا تعيد الطلبات المتكررة الترميز والضغط
+# المفتاح id(data) والقيمة تحمل data نفسه، فلا يُعاد استخدام id ما دامت موجودة هنا
+encoded_cache = TTLCache(CACHE_MAX_ENTRIES)
+
+
+def _encoded_body(data, view, encoding):
+    # يعيد (البايتات، الترميز الفعلي) لعرض معين من data
+    entry = encoded_cache.get(id(data))
+    if entry is None or entry[0] is not data:
+        entry = (data, {})
+        encoded_cache.set(id(data), entry, CACHE_TTL)
+    variants = entry[1]
+
+    cached = variants.get((view, encoding))
+    if cached is not None:
+        return cached
+
+    plain = variants.get((view, None))
+    if plain is None:
+        with STAGE_SECONDS.labels("format_filter").time():
+            body = _render(data, *view[:2], kind=view[2], min_height=view[3], max_height=view[4], ext=view[5])
+        with STAGE_SECONDS.labels("response_encode").time():
+            plain = (_dumps(body), None)
+        if len(variants) < ENCODED_VARIANTS_MAX:
+            variants[(view, None)] = plain
+    if encoding is None or len(plain[0]) < COMPRESS_MIN_BYTES:
+        return plain
+
+    with STAGE_SECONDS.labels("response_encode").time():
+        result = (_compress(plain[0], encoding), encoding)
+    if len(variants) < ENCODED_VARIANTS_MAX:
+        variants[(view, encoding)] = result
+    return result
+
+
+# الحقول الافتراضية لكل صيغة في استجابة /resolve
+RESOLVE_FORMAT_FIELDS = ("format_id", "ext", "resolution", "vcodec", "acodec", "filesize", "url", "expires_at")
+
+_QUALITY_RE = re.compile(r"^(\d+)p?$")
+
+
+def _codec(name):
+    # avc1.640028 -> avc1، mp4a.40.2 -> mp4a
+    return (name or "none").split(".")[0]
+
+
+def _bitrate(f):
+    return f.tbr or f.abr or 0
+
+
+def _merged_ext(formats):
+    # نفس الحاوية التي كان yt-dlp سيختارها عند دمج هذه الصيغ
+    video = [f for f in formats if f.vcodec != "none"]
+    audio = [f for f in formats if f.acodec != "none"]
+    return yt_dlp.utils.get_compatible_ext(
+        vcodecs=[f.vcodec for f in video],
+        acodecs=[f.acodec for f in audio],
+        vexts=[f.ext for f in video],
+        aexts=[f.ext for f in audio],
+    )
+
+
+def _build_ladder(formats):
+    # سلم الجودة: أفضل صيغة مدمجة لكل ارتفاع، أفضل صوت لكل ترميز، وأفضل صورة فقط لكل ارتفاع وترميز
+    muxed, video, audio = {}, {}, {}
+    for f in formats:
+        kind = _format_kind(f)
+        if kind == "audio":
+            table, slot = audio, _codec(f.acodec)
+        elif kind == "video":
+            table, slot = video, (f.height or 0, _codec(f.vcodec))
+        else:
+            table, slot = muxed, f.height or 0
+        if slot not in table or _bitrate(f) > _bitrate(table[slot]):
+            table[slot] = f
+
+    best_audio = max(audio.values(), key=_bitrate, default=None)
+
+    def pair_audio(v):
+        # صوت من نفس الحاوية أولاً (m4a مع mp4، webm مع webm) حتى يكفي الدمج بدون تحويل
+        same = [a for a in audio.values() if a.ext == {"mp4": "m4a"}.get(v.ext, v.ext)]
+        return max(same, key=_bitrate) if same else best_audio
+
+    # الاختيار لكل ارتفاع محسوب مسبقاً: المدمجة إن وجدت، وإلا أفضل صورة + الصوت المناسب لها
+    picks = {}
+    for height in {h for h, _ in video} | set(muxed):
+        if height in muxed:
+            picks[height] = (muxed[height],)
+            continue
+        v = max((f for (h, _), f in video.items() if h == height), key=_bitrate)
+        picks[height] = (v, pair_audio(v)) if best_audio is not None else (v,)
+
+    return {
+        "muxed": muxed,
+        "video": video,
+        "audio": audio,
+        "best_audio": best_audio,
+        "heights": sorted(picks),
+        "picks": picks,
+        "resolved": {},
+    }
+
+
+# السلم يُبنى مرة واحدة لكل نتيجة مخزنة (بنفس أسلوب encoded_cache)
+ladder_cache = TTLCache(CACHE_MAX_ENTRIES)
+
+
+def _ladder(data):
+    entry = ladder_cache.get(id(data))
+    if entry is None or entry[0] is not data:
+        with STAGE_SECONDS.labels("format_select").time():
+            entry = (data, _build_ladder(data["formats"]))
+        ladder_cache.set(id(data), entry, CACHE_TTL)
+    return entry[1]
+
+
+# محلل صيغ yt-dlp (مثل bv*[height<=1080]+ba/b) يُستخدم من حلقة الأحداث فقط، بدون أي شبكة
+_selector_ydl = None
+
+
+@lru_cache(maxsize=256)
+def _format_selector(spec):
+    global _selector_ydl
+    if _selector_ydl is None:
+        # check_formats=False يمنع اختبار الروابط أثناء الاختيار
+        _selector_ydl = yt_dlp.YoutubeDL({"quiet": True, "no_warnings": True, "check_formats": False})
+    return _selector_ydl.build_format_selector(spec)
+
+
+def _select_by_spec(data, ladder, spec):
+    try:
+        selector = _format_selector(spec)
+    except (SyntaxError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid format spec: {e}")
+
+    # قواميس الصيغ بالشكل الذي يتوقعه yt-dlp، تُبنى مرة واحدة لكل سلم
+    ctx = ladder.get("ctx")
+    if ctx is None:
+        formats = [f._asdict() for f in data["formats"]]
+        ctx = ladder["ctx"] = {
+            "formats": formats,
+            "has_merged_format": any("none" not in (f["acodec"], f["vcodec"]) for f in formats),
+            "incomplete_formats": (
+                all(f["vcodec"] == "none" for f in formats) or all(f["acodec"] == "none" for f in formats)
+            ),
+        }
+    # كل استجابة تحمل اختياراً واحداً (صيغة أو صورة + صوت)، فنرفض ما يختار عدة صيغ مثل all أو bv,ba
+    selections = selector(ctx)
+    chosen = next(selections, None)
+    if chosen is None:
+        return None
+    if next(selections, None) is not None:
+        raise HTTPException(status_code=400, detail="Format spec must select a single format or merge, not several")
+    by_id = {f.format_id: f for f in data["formats"]}
+    return tuple(by_id[f["format_id"]] for f in chosen.get("requested_formats", (chosen,)))
+
+
+def _select_by_quality(ladder, quality):
+    # best: أعلى ارتفاع، audio: أفضل صوت، 720 أو 720p: أعلى ارتفاع لا يتجاوز 720
+    if quality == "audio":
+        return (ladder["best_audio"],) if ladder["best_audio"] is not None else None
+    heights = ladder["heights"]
+    if not heights:
+        return None
+    if quality == "best":
+        return ladder["picks"][heights[-1]]
+    m = _QUALITY_RE.match(quality)
+    if m is None:
+        raise HTTPException(status_code=400, detail="quality must be like 720p, best or audio")
+    # إن كانت كل الارتفاعات أعلى من المطلوب نعيد أقلها
+    index = bisect.bisect_right(heights, int(m.group(1)))
+    return ladder["picks"][heights[max(index - 1, 0)]]
+
+
+def _resolve(data, quality=None, format_spec=None):
+    # يعيد الصيغ المختارة (واحدة، أو صورة + صوت يجب دمجهما)، ويحفظ النتيجة في السلم
+    ladder = _ladder(data)
+    query = ("quality", quality.lower()) if quality is not None else ("format", format_spec)
+    if query in ladder["resolved"]:
+        return ladder["resolved"][query]
+    with STAGE_SECONDS.labels("format_select").time():
+        if quality is not None:
+            chosen = _select_by_quality(ladder, query[1])
+        else:
+            chosen = _select_by_spec(data, ladder, format_spec)
+    if len(ladder["resolved"]) < 64:
+        ladder["resolved"][query] = chosen
+    return chosen
+
+
+def _format_view(f, include):
+    return {field: getattr(f, field) for field in include}
+
+
 @app.post("/extract-video")
-async def extract_video(req: VideoRequest):
+async def extract_video(
+    req: VideoRequest,
+    request: Request,
+    fields: Optional[str] = None,
+    include: Optional[str] = None,
+    kind: Optional[str] = None,
+    min_height: Optional[int] = None,
+    max_height: Optional[int] = None,
+    ext: Optional[str] = None,
+):
+    # fields: حقول الاستجابة، include: حقول كل صيغة، والباقي مرشحات للصيغ
+    # مثال: ?fields=title,formats&include=format_id,url&kind=muxed&max_height=720&ext=mp4
+    _view_fields(fields, include, kind)
     video_url = req.url
 
-    ydl_opts = {
-        "format": "best",
-        "quiet": True,
-        "no_warnings": True,
-        # لو عندك ملف cookies استخدمه هكذا:
-        # "cookiefile": "cookies.txt",
-    }
+    try:
+        data = await _until_disconnected(
+            request, _get_video(str(video_url), time.monotonic() + REQUEST_DEADLINE, _client_id(request))
+        )
+    except ExtractionError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    view = (fields, include, kind, min_height, max_height, ext)
+    body, encoding = _encoded_body(data, view, _negotiate_encoding(request.headers.get("accept-encoding")))
+    headers = {"vary": "Accept-Encoding"}
+    if encoding is not None:
+        headers["content-encoding"] = encoding
+    return Response(body, media_type="application/json", headers=headers)
+
+
+@app.post("/extract-videos")
+async def extract_videos(req: BatchRequest, request: Request):
+    if len(req.urls) > BATCH_MAX_URLS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_URLS} URLs per batch")
+
+    sem = asyncio.Semaphore(BATCH_CONCURRENCY)
+    client = _client_id(request)
+
+    async def one(index, url):
+        async with sem:
+            try:
+                return {"index": index, "url": url, "ok": True, "data": _render(await _get_video(url, client=client))}
+            except ExtractionError as e:
+                return {"index": index, "url": url, "ok": False, "status": 400, "error": str(e)}
+            except HTTPException as e:
+                return {"index": index, "url": url, "ok": False, "status": e.status_code, "error": e.detail}
+
+    async def results():
+        # كل نتيجة تُرسل كسطر NDJSON فور انتهائها (بترتيب الانتهاء وليس ترتيب الإدخال)
+        tasks = [asyncio.ensure_future(one(i, str(url))) for i, url in enumerate(req.urls)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                item = await next_done
+                yield _dumps(item) + b"\n"
+        finally:
+            # إذا انقطع العميل نلغي ما تبقى (الاستخراج المشترك محمي بـ shield)
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+
+@app.get("/resolve")
+async def resolve(
+    request: Request,
+    url: HttpUrl,
+    quality: Optional[str] = None,
+    format_spec: Optional[str] = Query(None, alias="format"),
+    include: Optional[str] = None,
+):
+    # quality=1080p أو format=<صيغة yt-dlp>؛ بدونهما نعيد سلم الجودة كاملاً
+    # مثال: /resolve?url=...&quality=1080p أو /resolve?url=...&format=bv*[height<=720]+ba/b
+    if quality is not None and format_spec is not None:
+        raise HTTPException(status_code=400, detail="Use either quality or format, not both")
+    include = _split(include) or RESOLVE_FORMAT_FIELDS
+    unknown = [f for f in include if f not in Format._fields]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown field(s): {', '.join(unknown)}")
 
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(str(video_url), download=False)
-        # أعد فقط البيانات التي تحتاجها للواجهة (مثل العنوان، الوصف، والصيغ المتاحة)
-        formats = []
-        for f in info.get("formats", []):
-            formats.append({
-                "format_id": f.get("format_id"),
-                "ext": f.get("ext"),
-                "resolution": f.get("resolution") or f.get("height"),
-                "filesize": f.get("filesize"),
-                "url": f.get("url"),
-            })
+        data = await _until_disconnected(
+            request, _get_video(str(url), time.monotonic() + REQUEST_DEADLINE, _client_id(request))
+        )
+    except ExtractionError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
+    if quality is None and format_spec is None:
+        ladder = _ladder(data)
         return {
-            "title": info.get("title"),
-            "thumbnail": info.get("thumbnail"),
-            "duration": info.get("duration"),
-            "formats": formats,
+            "title": data.get("title"),
+            "muxed": [_format_view(f, include) for _, f in sorted(ladder["muxed"].items())],
+            "video": [_format_view(f, include) for _, f in sorted(ladder["video"].items())],
+            "audio": [_format_view(f, include) for f in sorted(ladder["audio"].values(), key=_bitrate)],
         }
-    except Exception as e:
+
+    chosen = _resolve(data, quality, format_spec)
+    if not chosen:
+        raise HTTPException(status_code=404, detail="Requested format is not available")
+    return {
+        "title": data.get("title"),
+        "format_id": "+".join(f.format_id for f in chosen),
+        "ext": _merged_ext(chosen) if len(chosen) > 1 else chosen[0].ext,
+        # merge=true: الصورة والصوت منفصلان ويجب دمجهما (أو تحميلهما معاً)
+        "merge": len(chosen) > 1,
+        "formats": [_format_view(f, include) for f in chosen],
+        "expires_at": _earliest_expiry(chosen),
+    }
+
+
+@app.post("/extract-playlist")
+async def extract_playlist(req: PlaylistRequest, request: Request):
+    if req.offset < 0 or not 0 < req.limit <= PLAYLIST_PAGE_MAX:
+        raise HTTPException(status_code=400, detail=f"offset must be >= 0 and limit between 1 and {PLAYLIST_PAGE_MAX}")
+
+    url = str(req.url)
+    client = _client_id(request)
+    # playlist_items يبدأ العد من 1
+    start, end = req.offset + 1, req.offset + req.limit
+    key = ("playlist", url, start, end)
+
+    page = playlist_cache.get(key)
+    if page is None:
+        async def fetch():
+            page = await gate.run(_extract_playlist, url, start, end, client=client)
+            playlist_cache.set(key, page, PLAYLIST_CACHE_TTL)
+            return page
+
+        try:
+            page = await _until_disconnected(request, flights.do(key, fetch))
+        except ExtractionError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    # إذا امتلأت الصفحة فغالباً توجد صفحة تالية؛ صيغ كل عنصر تُجلب عبر /extract-video عند الحاجة
+    next_offset = req.offset + req.limit if len(page["entries"]) == req.limit else None
+    return {**page, "offset": req.offset, "limit": req.limit, "next_offset": next_offset}
+
+
+def _require_admin(request):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if request.headers.get("authorization") != f"Bearer {ADMIN_TOKEN}":
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+@app.get("/admin/limits")
+async def get_limits(request: Request):
+    _require_admin(request)
+    return limiter.limits
+
+
+@app.put("/admin/limits")
+async def set_limits(limits: RateLimits, request: Request):
+    _require_admin(request)
+    limiter.configure(limits)
+    return limiter.limits
+
+
+@app.get("/metrics")
+async def metrics():
+    # مع عدة عمال uvicorn نجمع المقاييس من كل العمليات عبر PROMETHEUS_MULTIPROC_DIR
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+# الترويسات التي نمررها من العميل إلى المصدر، ومن المصدر إلى العميل
+_FORWARD_REQUEST_HEADERS = ("range", "if-range")
+_FORWARD_RESPONSE_HEADERS = (
+    "content-type",
+    "content-length",
+    "content-range",
+    "accept-ranges",
+    "etag",
+    "last-modified",
+)
+
+
+def _content_disposition(title, ext):
+    name = (title or "video").replace("/", "_").replace("\\", "_")
+    if ext:
+        name = f"{name}.{ext}"
+    return f"attachment; filename*=UTF-8''{quote(name)}"
+
+
+@app.get("/download")
+async def download(request: Request, url: HttpUrl, format_id: str):
+    try:
+        data = await _until_disconnected(
+            request, _get_video(str(url), time.monotonic() + REQUEST_DEADLINE, _client_id(request))
+        )
+    except ExtractionError as e:
         raise HTTPException(status_code=400, detail=str(e))
+
+    fmt = next((f for f in data["formats"] if f.format_id == format_id), None)
+    if fmt is None or not fmt.url:
+        raise HTTPException(status_code=404, detail="Format not found")
+    return await _proxy(request, fmt, _content_disposition(data.get("title"), fmt.ext))
+
+
+async def _proxy(request, fmt, disposition):
+    # نمرر Range/If-Range حتى يعمل التقديم والاستئناف في المتصفح ومديري التحميل
+    headers = {k: request.headers[k] for k in _FORWARD_REQUEST_HEADERS if k in request.headers}
+    # الاستجابة تبقى مفتوحة بعد خروج الدالة، لذلك نغلقها من داخل مولد البث
+    # (العناوين الداخلية يرفضها PublicNetworkBackend بـ 403 قبل الاتصال)
+    stack = AsyncExitStack()
+    try:
+        resp = await stack.enter_async_context(upstream.stream(fmt.url, headers))
+    except httpx.HTTPError as e:
+        await stack.aclose()
+        raise HTTPException(status_code=502, detail=f"Upstream error: {e}")
+
+    if resp.status_code >= 400 and resp.status_code != 416:
+        await stack.aclose()
+        raise HTTPException(status_code=502, detail=f"Upstream returned {resp.status_code}")
+
+    response_headers = {k: resp.headers[k] for k in _FORWARD_RESPONSE_HEADERS if k in resp.headers}
+    response_headers["content-disposition"] = disposition
+
+    async def body():
+        # نبث الملف على أجزاء ثابتة الحجم دون تحميله كاملاً في الذاكرة
+        try:
+            async for chunk in resp.aiter_raw(DOWNLOAD_CHUNK_SIZE):
+                yield chunk
+        finally:
+            await stack.aclose()
+
+    return StreamingResponse(body(), status_code=resp.status_code, headers=response_headers)
+
+
+# حاويات الدمج: mp4 مجزأ (يُبث بدون الرجوع لكتابة moov في البداية) أو mkv
+MUX_CONTAINERS = {
+    "mp4": (["-f", "mp4", "-movflags", "frag_keyframe+empty_moov+default_base_moof"], "video/mp4"),
+    "mkv": (["-f", "matroska"], "video/x-matroska"),
+}
+
+
+async def _pipe_writer(fd):
+    # طرف كتابة أنبوب كـ StreamWriter حتى نحترم الضغط العكسي (drain) بدون حجب حلقة الأحداث
+    loop = asyncio.get_running_loop()
+    pipe = open(fd, "wb", buffering=0)
+    transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, pipe)
+    return asyncio.StreamWriter(transport, protocol, None, loop)
+
+
+async def _feed(resp, writer):
+    # ننسخ بث المصدر إلى مدخل ffmpeg؛ إذا أنهى ffmpeg عمله مبكراً نتوقف بهدوء
+    try:
+        async for chunk in resp.aiter_raw(DOWNLOAD_CHUNK_SIZE):
+            writer.write(chunk)
+            await writer.drain()
+    except (BrokenPipeError, ConnectionResetError, httpx.HTTPError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _start_ffmpeg(args, inputs):
+    # يشغل ffmpeg مع كل مدخل على أنبوب مستقل (pipe:3، pipe:4 ...) ويعيد (العملية، مهام التغذية)
+    # لا شيء يُكتب على القرص: المدخلات من المصدر مباشرة والمخرج على stdout
+    pipes = [os.pipe() for _ in inputs]
+    cmd = [FFMPEG_PATH, "-nostdin", "-hide_banner", "-loglevel", "error"]
+    for r, _ in pipes:
+        cmd += ["-i", f"pipe:{r}"]
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, *args, "pipe:1",
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            pass_fds=[r for r, _ in pipes],
+        )
+    except OSError:
+        for _, w in pipes:
+            os.close(w)
+        raise HTTPException(status_code=503, detail="ffmpeg is not available on this server")
+    finally:
+        # أطراف القراءة أصبحت ملكاً لـ ffmpeg
+        for r, _ in pipes:
+            os.close(r)
+    if FFMPEG_CPU_LIMIT > 0:
+        try:
+            resource.prlimit(proc.pid, resource.RLIMIT_CPU, (FFMPEG_CPU_LIMIT, FFMPEG_CPU_LIMIT + 5))
+        except (AttributeError, OSError):
+            pass  # prlimit متاح على لينكس فقط
+    feeders = [asyncio.ensure_future(_feed(resp, await _pipe_writer(w))) for resp, (_, w) in zip(inputs, pipes)]
+    return proc, feeders
+
+
+async def _stop_ffmpeg(proc, feeders):
+    for task in feeders:
+        task.cancel()
+    if proc.returncode is None:
+        proc.kill()
+    await proc.wait()
+
+
+async def _ffmpeg_stream(request, formats, args, media_type, disposition):
+    # ينتظر مكاناً في مجمع ffmpeg، يفتح بث كل صيغة من المصدر ويعيد مخرج ffmpeg كبث للعميل
+    # الضغط العكسي متصل: العميل البطيء يوقف قراءة stdout، فيتوقف ffmpeg، فتتوقف قراءة المصدر
+    await ffmpeg_pool.acquire(_client_id(request))
+    stack = AsyncExitStack()
+    stack.callback(ffmpeg_pool.release)
+    try:
+        inputs = []
+        for fmt in formats:
+            resp = await stack.enter_async_context(upstream.stream(fmt.url))
+            if resp.status_code >= 400:
+                raise HTTPException(status_code=502, detail=f"Upstream returned {resp.status_code}")
+            inputs.append(resp)
+        proc, feeders = await _start_ffmpeg(args, inputs)
+        stack.push_async_callback(_stop_ffmpeg, proc, feeders)
+    except httpx.HTTPError as e:
+        await stack.aclose()
+        raise HTTPException(status_code=502, detail=f"Upstream error: {e}")
+    except BaseException:
+        await stack.aclose()
+        raise
+
+    async def body():
+        # لا Content-Length ولا Range: الحجم النهائي غير معروف قبل انتهاء ffmpeg
+        try:
+            while True:
+                chunk = await proc.stdout.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            await stack.aclose()
+
+    return StreamingResponse(body(), media_type=media_type, headers={"content-disposition": disposition})
+
+
+@app.get("/mux")
+async def mux(request: Request, url: HttpUrl, format_id: str, container: Optional[str] = None):
+    # format_id بالشكل الذي يعيده /resolve، مثل 299+140: صورة فقط + صوت فقط
+    # ffmpeg ينسخ المسارات كما هي (-c copy) إلى mp4 مجزأ أو mkv ويُبث الناتج فور إنتاجه
+    if container is not None and container not in MUX_CONTAINERS:
+        raise HTTPException(status_code=400, detail=f"container must be one of {', '.join(MUX_CONTAINERS)}")
+    ids = format_id.split("+")
+    if len(ids) != 2:
+        raise HTTPException(status_code=400, detail="format_id must be <video>+<audio>, use /download for a single format")
+
+    try:
+        data = await _until_disconnected(
+            request, _get_video(str(url), time.monotonic() + REQUEST_DEADLINE, _client_id(request))
+        )
+    except ExtractionError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    by_id = {f.format_id: f for f in data["formats"]}
+    video, audio = by_id.get(ids[0]), by_id.get(ids[1])
+    if video is None or audio is None or not video.url or not audio.url:
+        raise HTTPException(status_code=404, detail="Format not found")
+    if video.vcodec == "none" or audio.acodec == "none":
+        raise HTTPException(status_code=400, detail="format_id must be <video>+<audio>")
+    if container is None:
+        container = "mp4" if _merged_ext((video, audio)) == "mp4" else "mkv"
+    muxer, media_type = MUX_CONTAINERS[container]
+
+    args = ["-map", "0:v:0", "-map", "1:a:0", "-c", "copy", *muxer]
+    disposition = _content_disposition(data.get("title"), container)
+    return await _ffmpeg_stream(request, (video, audio), args, media_type, disposition)
+
+
+class AudioCodec(NamedTuple):
+    family: str  # اسم الترميز في المصدر كما يعيده _codec (mp4a، opus ...)
+    ext: str
+    media_type: str
+    encoder: str
+    muxer: List[str]
+    bitrate: int  # kbps عند التحويل
+
+
+AUDIO_CODECS = {
+    "mp3": AudioCodec("mp3", "mp3", "audio/mpeg", "libmp3lame", ["-f", "mp3"], 192),
+    "opus": AudioCodec("opus", "opus", "audio/ogg", "libopus", ["-f", "ogg"], 128),
+    "m4a": AudioCodec("mp4a", "m4a", "audio/mp4", "aac", MUX_CONTAINERS["mp4"][0], 192),
+}
+
+
+@app.get("/audio")
+async def extract_audio(request: Request, url: HttpUrl, codec: str = "mp3", bitrate: Optional[int] = None):
+    # صوت فقط بصيغة mp3 أو opus أو m4a، بثلاث طرق من الأرخص للأغلى:
+    # passthrough: المصدر بنفس الترميز والحاوية فيُمرر كما هو (مع دعم Range)
+    # copy: نفس الترميز بحاوية أخرى (opus في webm -> ogg) فينسخه ffmpeg بدون تحويل
+    # transcode: تحويل فعلي عبر ffmpeg بمعدل bitrate (أو الافتراضي للترميز)
+    target = AUDIO_CODECS.get(codec)
+    if target is None:
+        raise HTTPException(status_code=400, detail=f"codec must be one of {', '.join(AUDIO_CODECS)}")
+    if bitrate is not None and not 32 <= bitrate <= 320:
+        raise HTTPException(status_code=400, detail="bitrate must be between 32 and 320 kbps")
+
+    try:
+        data = await _until_disconnected(
+            request, _get_video(str(url), time.monotonic() + REQUEST_DEADLINE, _client_id(request))
+        )
+    except ExtractionError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    ladder = _ladder(data)
+    disposition = _content_disposition(data.get("title"), target.ext)
+    same = ladder["audio"].get(target.family) if bitrate is None else None
+    if same is not None and same.url and same.ext == target.ext:
+        return await _proxy(request, same, disposition)
+    if same is not None and same.url:
+        args = ["-map", "0:a:0", "-vn", "-c:a", "copy", *target.muxer]
+        return await _ffmpeg_stream(request, (same,), args, target.media_type, disposition)
+
+    # بدون صيغة صوت فقط (مواقع تقدم صيغاً مدمجة فقط) نأخذ الصوت من أفضل صيغة مدمجة
+    source = ladder["best_audio"] or max(ladder["muxed"].values(), key=_bitrate, default=None)
+    if source is None or not source.url:
+        raise HTTPException(status_code=404, detail="No audio format available")
+    args = ["-map", "0:a:0", "-vn", "-c:a", target.encoder, "-b:a", f"{bitrate or target.bitrate}k", *target.muxer]
+    return await _ffmpeg_stream(request, (source,), args, target.media_type, disposition)
+
+
+JOB_PRIORITIES = {"low": 0, "normal": 1, "high": 2}
+JOB_FINAL_STATES = ("done", "failed", "cancelled")
+
+# أسماء معالجات yt-dlp اللاحقة التي تظهر كمرحلة مستقلة في التقدم
+_JOB_STAGES = {"Merger": "merging", "ExtractAudio": "converting"}
+
+
+class JobCancelled(yt_dlp.utils.DownloadCancelled):
+    # يُرفع من خطافات التقدم؛ yt-dlp يمرر DownloadCancelled كما هو بدل تحويله إلى DownloadError
+    msg = "Job cancelled"
+
+
+class JobQueue:
+    # طابور مهام دائم في SQLite: الأولوية الأعلى ثم الأقدم، ولا تضيع المهام عند إعادة التشغيل
+    # العمال مهام asyncio، والتحميل نفسه يعمل في خيوط لأن yt-dlp يحجب الخيط
+    def __init__(self, path, directory, workers):
+        self.path = path
+        self.directory = directory
+        self.workers = workers
+        self.executor = None
+        self._lock = threading.Lock()
+        self._conn = None
+        self._wakeup = None
+        self._tasks = []
+        self._stopping = False
+        self._cancelled = set()
+        self._running = set()
+        self._last_write = {}
+        self._last_publish = {}  # job_id -> (المرحلة، وقت آخر نشر)
+
+    def _connection(self):
+        if self._conn is None:
+            os.makedirs(self.directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, url TEXT NOT NULL, options TEXT NOT NULL, priority INTEGER NOT NULL,"
+                " state TEXT NOT NULL, progress TEXT NOT NULL, file TEXT, error TEXT, owner INTEGER,"
+                " created REAL NOT NULL, updated REAL NOT NULL, cancel_requested INTEGER NOT NULL DEFAULT 0)"
+            )
+            # قواعد أنشأتها نسخ أقدم لا تحوي عمود طلب الإلغاء
+            if "cancel_requested" not in {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}:
+                conn.execute("ALTER TABLE jobs ADD COLUMN cancel_requested INTEGER NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (state, priority DESC, created)")
+            self._conn = conn
+        return self._conn
+
+    async def start(self):
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix="job")
+        await asyncio.to_thread(self._recover)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._sweep_loop()))
+
+    async def stop(self):
+        # المهام الجارية تتوقف عند أول تحديث للتقدم وتعود إلى الطابور لتكمل بعد إعادة التشغيل
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _recover(self):
+        # مهام "running" تركتها عملية ماتت (أو نسخة سابقة منا بنفس pid داخل الحاوية) تعود للطابور
+        with self._lock:
+            conn = self._connection()
+            rows = conn.execute("SELECT id, owner, cancel_requested FROM jobs WHERE state = 'running'").fetchall()
+            for job_id, owner, cancel_requested in rows:
+                if owner != os.getpid() and _pid_alive(owner):
+                    continue
+                if cancel_requested:
+                    # أُلغيت قبل أن تلاحظ العملية المالكة ذلك
+                    self._finish(conn, job_id, "cancelled", {"stage": "cancelled"})
+                    shutil.rmtree(os.path.join(self.directory, job_id), ignore_errors=True)
+                else:
+                    conn.execute(
+                        "UPDATE jobs SET state = 'queued', owner = NULL, updated = ? WHERE id = ?",
+                        (time.time(), job_id),
+                    )
+
+    def submit(self, url, options, priority):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        progress = _dumps({"stage": "queued"}).decode()
+        with self._lock:
+            conn = self._connection()
+            queued = conn.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0]
+            if queued >= JOBS_MAX_QUEUED:
+                raise _overloaded("Too many queued jobs, please retry later", JOBS_POLL_INTERVAL)
+            conn.execute(
+                "INSERT INTO jobs (id, url, options, priority, state, progress, created, updated)"
+                " VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)",
+                (job_id, url, _dumps(options).decode(), priority, progress, now, now),
+            )
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job_id
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT id, url, options, priority, state, progress, file, error, created, updated"
+                " FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        names = ("id", "url", "options", "priority", "state", "progress", "file", "error", "created", "updated")
+        job = dict(zip(names, row))
+        job["options"] = _loads(job["options"])
+        job["progress"] = _loads(job["progress"])
+        return job
+
+    def cancel(self, job_id):
+        # المهمة في الطابور تُلغى فوراً؛ الجارية تتوقف عند أول تحديث للتقدم
+        # الطلب يُحفظ في القاعدة لأن المهمة قد تعمل في عملية أخرى تراه عند كتابة التقدم
+        # القراءة والتحديث في معاملة واحدة (كما في _claim) حتى لا تأخذ عملية أخرى المهمة بينهما
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT state FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                if row is not None and row[0] == "queued":
+                    self._finish(conn, job_id, "cancelled", {"stage": "cancelled"})
+                elif row is not None and row[0] == "running":
+                    conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (job_id,))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            if row is None:
+                return None
+            if row[0] == "queued":
+                hub.publish_threadsafe("job:" + job_id, {"id": job_id, "state": "cancelled", "stage": "cancelled"})
+            elif row[0] == "running" and job_id in self._running:
+                self._cancelled.add(job_id)
+        return row[0]
+
+    def _claim(self):
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT id, url, options FROM jobs WHERE state = 'queued'"
+                    " ORDER BY priority DESC, created LIMIT 1"
+                ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE jobs SET state = 'running', owner = ?, updated = ? WHERE id = ?",
+                        (os.getpid(), time.time(), row[0]),
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return row
+
+    def _finish(self, conn, job_id, state, progress, file=None, error=None):
+        conn.execute(
+            "UPDATE jobs SET state = ?, progress = ?, file = ?, error = ?, owner = NULL, updated = ? WHERE id = ?",
+            (state, _dumps(progress).decode(), file, error, time.time(), job_id),
+        )
+
+    def report(self, job_id, progress, force=False):
+        # يُستدعى من خيط التحميل؛ الكتابة في القاعدة محدودة بـ JOBS_PROGRESS_INTERVAL
+        if self._stopping or job_id in self._cancelled:
+            raise JobCancelled()
+        now = time.monotonic()
+        stage, published = self._last_publish.get(job_id, (None, 0))
+        if force or progress.get("stage") != stage or now - published >= PROGRESS_MIN_INTERVAL:
+            self._last_publish[job_id] = (progress.get("stage"), now)
+            hub.publish_threadsafe("job:" + job_id, {"id": job_id, "state": "running", **progress})
+        if not force and now - self._last_write.get(job_id, 0) < JOBS_PROGRESS_INTERVAL:
+            return
+        self._last_write[job_id] = now
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "UPDATE jobs SET progress = ?, updated = ? WHERE id = ?",
+                (_dumps(progress).decode(), time.time(), job_id),
+            )
+            cancel_requested = self._cancel_requested(conn, job_id)
+        if cancel_requested:
+            self._cancelled.add(job_id)
+            raise JobCancelled()
+
+    def _cancel_requested(self, conn, job_id):
+        row = conn.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    async def _worker(self):
+        while True:
+            row = await asyncio.to_thread(self._claim)
+            if row is None:
+                self._wakeup.clear()
+                try:
+                    # مهمة جديدة في هذه العملية توقظنا فوراً؛ مهام العمليات الأخرى نراها عند الفحص الدوري
+                    await asyncio.wait_for(self._wakeup.wait(), JOBS_POLL_INTERVAL)
+                except TimeoutError:
+                    pass
+                continue
+            job_id, url, options = row
+            await asyncio.get_running_loop().run_in_executor(self.executor, self._run, job_id, url, _loads(options))
+
+    def _run(self, job_id, url, options):
+        job_dir = os.path.join(self.directory, job_id)
+        state, progress, file, error = "done", {"stage": "done"}, None, None
+        self._running.add(job_id)
+        try:
+            self.report(job_id, {"stage": "extracting"}, force=True)
+            path = _download_job(job_id, url, options, job_dir)
+            file = os.path.relpath(path, self.directory)
+            progress["size"] = os.path.getsize(path)
+        except JobCancelled:
+            if self._stopping and job_id not in self._cancelled and not self._cancel_requested_now(job_id):
+                # إيقاف الخادم: تعود المهمة للطابور وتكمل من الملفات الجزئية (.part) لاحقاً
+                state, progress = "queued", {"stage": "queued"}
+            else:
+                state, progress = "cancelled", {"stage": "cancelled"}
+        except Exception as e:
+            state, progress, error = "failed", {"stage": "failed"}, getattr(e, "detail", None) or str(e)
+        finally:
+            self._last_write.pop(job_id, None)
+            self._last_publish.pop(job_id, None)
+        if state == "cancelled":
+            shutil.rmtree(job_dir, ignore_errors=True)
+        with self._lock:
+            self._finish(self._connection(), job_id, state, progress, file, error)
+            # داخل القفل حتى لا يضيف cancel() المعرّف بعد حذفه فيبقى في الذاكرة
+            self._running.discard(job_id)
+            self._cancelled.discard(job_id)
+        hub.publish_threadsafe("job:" + job_id, _job_event(self.get(job_id)))
+
+    def _cancel_requested_now(self, job_id):
+        with self._lock:
+            return self._cancel_requested(self._connection(), job_id)
+
+    def running(self, job_id):
+        return job_id in self._running
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.to_thread(self._sweep)
+            await asyncio.sleep(max(JOBS_POLL_INTERVAL, 60))
+
+    def _sweep(self):
+        # نحذف المهام المنتهية وملفاتها بعد JOBS_RESULT_TTL
+        cutoff = time.time() - JOBS_RESULT_TTL
+        with self._lock:
+            conn = self._connection()
+            doomed = [
+                row[0] for row in conn.execute(
+                    "SELECT id FROM jobs WHERE state IN ('done', 'failed', 'cancelled') AND updated < ?", (cutoff,)
+                )
+            ]
+            conn.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in doomed])
+        for job_id in doomed:
+            shutil.rmtree(os.path.join(self.directory, job_id), ignore_errors=True)
+
+
+def _pid_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _download_job(job_id, url, options, job_dir):
+    # يعمل في خيط عامل: نسخة YoutubeDL خاصة بالمهمة لأن الخيارات (المسار، الصيغة، الخطافات) تخصها وحدها
+    progress = {}
+
+    def on_progress(d):
+        if d["status"] not in ("downloading", "finished"):
+            return
+        total = d.get("total_bytes") or d.get("total_bytes_estimate")
+        progress.update({
+            "stage": "downloading",
+            "format_id": (d.get("info_dict") or {}).get("format_id"),
+            "downloaded_bytes": d.get("downloaded_bytes"),
+            "total_bytes": total,
+            "speed": d.get("speed"),
+            "eta": d.get("eta"),
+            "percent": round(d["downloaded_bytes"] * 100 / total, 1) if total and d.get("downloaded_bytes") else None,
+        })
+        jobs.report(job_id, dict(progress), force=d["status"] == "finished")
+
+    def check_formats(info, *, incomplete):
+        # روابط الصيغ تأتي من الصفحة وقد تشير إلى الشبكة الداخلية، والملف يُعاد كاملاً عبر /jobs/{id}/file
+        if not incomplete:
+            for f in info.get("requested_formats") or (info,):
+                _require_public_url(f.get("url"))
+
+    def on_postprocess(d):
+        stage = _JOB_STAGES.get(d.get("postprocessor"))
+        if stage is not None and d["status"] == "started" and progress.get("stage") != stage:
+            progress.clear()
+            progress["stage"] = stage
+            jobs.report(job_id, dict(progress), force=True)
+
+    params = {
+        **YDL_OPTS,
+        "format": options["format"],
+        "outtmpl": os.path.join(job_dir, "%(title).150B [%(id)s].%(ext)s"),
+        "progress_hooks": [on_progress],
+        "postprocessor_hooks": [on_postprocess],
+        "match_filter": check_formats,
+        "noprogress": True,
+        "ffmpeg_location": FFMPEG_PATH,
+    }
+    if options.get("audio"):
+        params["postprocessors"] = [{
+            "key": "FFmpegExtractAudio",
+            "preferredcodec": options["audio"],
+            "preferredquality": str(options.get("bitrate") or AUDIO_CODECS[options["audio"]].bitrate),
+        }]
+
+    _require_public_url(url)
+    ydl = YDL_CLASS(params)
+    try:
+        info = ydl.extract_info(url, download=True)
+    finally:
+        ydl.close()
+    if info.get("_type") == "playlist":
+        raise ExtractionError("This URL is a playlist or channel, submit each video as its own job", "PlaylistURL")
+    return info["requested_downloads"][0]["filepath"]
+
+
+jobs = JobQueue(JOBS_DB, JOBS_DIR, JOBS_WORKERS)
+
+
+def _job_view(job):
+    view = {k: job[k] for k in ("id", "url", "state", "progress", "error", "created", "updated")}
+    view["priority"] = next(name for name, value in JOB_PRIORITIES.items() if value == job["priority"])
+    view["options"] = job["options"]
+    view["file_url"] = f"/jobs/{job['id']}/file" if job["state"] == "done" else None
+    return view
+
+
+def _job_event(job):
+    # رسالة التقدم كما تصل لمشتركي SSE/WebSocket
+    event = {"id": job["id"], "state": job["state"], **job["progress"]}
+    if job["state"] == "done":
+        event["file_url"] = f"/jobs/{job['id']}/file"
+    if job["error"]:
+        event["error"] = job["error"]
+    return event
+
+
+@app.post("/jobs", status_code=202)
+async def create_job(req: JobRequest, request: Request):
+    # تحميل (وتحويل اختياري) في الخلفية؛ التقدم عبر GET /jobs/{id} والملف عبر /jobs/{id}/file
+    if req.priority not in JOB_PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"priority must be one of {', '.join(JOB_PRIORITIES)}")
+    if req.audio is not None and req.audio not in AUDIO_CODECS:
+        raise HTTPException(status_code=400, detail=f"audio must be one of {', '.join(AUDIO_CODECS)}")
+    if req.bitrate is not None and not 32 <= req.bitrate <= 320:
+        raise HTTPException(status_code=400, detail="bitrate must be between 32 and 320 kbps")
+    try:
+        _format_selector(req.format)
+    except (SyntaxError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid format spec: {e}")
+    await asyncio.to_thread(_require_public_url, str(req.url))
+    limiter.check(_client_id(request))
+
+    options = {"format": req.format, "audio": req.audio, "bitrate": req.bitrate}
+    job_id = await asyncio.to_thread(jobs.submit, str(req.url), options, JOB_PRIORITIES[req.priority])
+    return _job_view(await asyncio.to_thread(jobs.get, job_id))
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await asyncio.to_thread(jobs.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return _job_view(job)
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    state = await asyncio.to_thread(jobs.cancel, job_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return _job_view(await asyncio.to_thread(jobs.get, job_id))
+
+
+@app.get("/jobs/{job_id}/file")
+async def get_job_file(job_id: str):
+    job = await asyncio.to_thread(jobs.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["state"] != "done":
+        raise HTTPException(status_code=409, detail=f"Job is {job['state']}")
+    path = os.path.join(JOBS_DIR, job["file"])
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=410, detail="Result has expired")
+    return FileResponse(path, headers={"content-disposition": _content_disposition(os.path.basename(path), None)})
+
+
+# المراحل التي ينتهي عندها البث
+PROGRESS_FINAL_STAGES = ("done", "failed", "cancelled")
+
+
+async def _job_poll(job_id, last_sent):
+    # الحالة الأولى من القاعدة دائماً؛ بعدها نقرأ القاعدة فقط إذا كانت المهمة لا تعمل في هذه العملية
+    # (في الطابور أو عند عامل في عملية أخرى) لأن أحداث العامل المحلي تصل عبر hub مباشرة
+    if last_sent is not None and jobs.running(job_id):
+        return []
+    job = await asyncio.to_thread(jobs.get, job_id)
+    if job is None:
+        return [{"id": job_id, "stage": "failed", "error": "Job not found"}]
+    event = _job_event(job)
+    return [event] if event != last_sent else []
+
+
+async def _progress_events(topic, poll=None, idle_timeout=None):
+    # يولد رسائل التقدم لموضوع واحد: الانتقالات كلها، والتحديثات بحد أقصى رسالة كل PROGRESS_MIN_INTERVAL
+    # None تعني "لا جديد" ليرسل المستدعي ping يحافظ على الاتصال
+    subscriber = hub.subscribe(topic)
+    try:
+        last_sent = None
+        pending = await poll(last_sent) if poll is not None else []
+        if not pending and hub.last(topic) is not None:
+            pending = [hub.last(topic)]
+        idle_since = time.monotonic()
+        while True:
+            for message in pending:
+                last_sent = message
+                yield message
+                if message.get("stage") in PROGRESS_FINAL_STAGES:
+                    return
+            if pending:
+                idle_since = time.monotonic()
+                # ما يصل خلال هذه المهلة يُدمج ويُرسل دفعة واحدة
+                await asyncio.sleep(PROGRESS_MIN_INTERVAL)
+            elif idle_timeout is not None and time.monotonic() - idle_since > idle_timeout:
+                return
+            else:
+                yield None
+            pending = await subscriber.next(JOBS_PROGRESS_INTERVAL if poll is not None else PROGRESS_PING_INTERVAL)
+            if not pending and poll is not None:
+                pending = await poll(last_sent)
+    finally:
+        hub.unsubscribe(topic, subscriber)
+
+
+def _progress_source(job_id, url):
+    # يعيد (الموضوع، دالة الفحص، مهلة الخمول) لمهمة أو لاستخراج رابط
+    if (job_id is None) == (url is None):
+        raise HTTPException(status_code=400, detail="Pass exactly one of job_id or url")
+    if job_id is not None:
+        return "job:" + job_id, lambda last_sent: _job_poll(job_id, last_sent), None
+    # نفس الشكل الموحد الذي ينشر به POST /extract-video (str(HttpUrl))
+    url = str(url)
+    key, target_url, _ = classify_url(url)
+    topic = "extract:" + target_url
+
+    async def cached(last_sent):
+        # النتيجة موجودة في الذاكرة ولا استخراج جارٍ: لا يوجد ما ننتظره
+        if last_sent is None and hub.last(topic) is None and metadata_cache.get(key or url_keys.get(url)) is not None:
+            return [{"stage": "done"}]
+        return []
+
+    return topic, cached, REQUEST_DEADLINE
+
+
+@app.get("/progress")
+async def progress_sse(job_id: Optional[str] = None, url: Optional[HttpUrl] = None):
+    # Server-Sent Events: /progress?job_id=... أو /progress?url=... (قبل أو أثناء POST /extract-video)
+    topic, poll, idle_timeout = _progress_source(job_id, url)
+
+    async def stream():
+        pinged = time.monotonic()
+        async with aclosing(_progress_events(topic, poll, idle_timeout)) as events:
+            async for message in events:
+                if message is not None:
+                    yield b"event: progress\ndata: " + _dumps(message) + b"\n\n"
+                elif time.monotonic() - pinged >= PROGRESS_PING_INTERVAL:
+                    pinged = time.monotonic()
+                    yield b": ping\n\n"
+
+    headers = {"cache-control": "no-cache", "x-accel-buffering": "no"}
+    return StreamingResponse(stream(), media_type="text/event-stream", headers=headers)
+
+
+@app.websocket("/progress/ws")
+async def progress_ws(websocket: WebSocket, job_id: Optional[str] = None, url: Optional[HttpUrl] = None):
+    try:
+        topic, poll, idle_timeout = _progress_source(job_id, url)
+    except HTTPException as e:
+        await websocket.close(code=1008, reason=e.detail)
+        return
+    await websocket.accept()
+
+    async def closed():
+        # الرسائل من العميل لا تعنينا، لكن قراءتها تكشف إغلاق الاتصال أثناء الانتظار
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+
+    watcher = asyncio.ensure_future(closed())
+    try:
+        async with aclosing(_progress_events(topic, poll, idle_timeout)) as events:
+            async for message in events:
+                if watcher.done():
+                    return
+                if message is not None:
+                    await websocket.send_text(_dumps(message).decode())
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        watcher.cancel()
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# main.py في جذر المستودع؛ ونعطل ذاكرة القرص حتى لا تتأثر الاختبارات بتشغيلات سابقة
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("CACHE_DB", "")
@@ -0,0 +1,32 @@
+from fastapi.testclient import TestClient
+
+import main
+
+
+def test_bad_view_is_rejected_before_extraction(monkeypatch):
+    async def never(*args, **kwargs):
+        raise AssertionError("extraction should not run")
+
+    monkeypatch.setattr(main, "_get_video", never)
+    with TestClient(main.app) as client:
+        for params in ({"fields": "bogus"}, {"include": "bogus"}, {"kind": "bogus"}):
+            r = client.post("/extract-video", params=params, json={"url": "https://youtu.be/abcdefghijk"})
+            assert r.status_code == 400
+
+
+def test_job_for_private_address_is_refused():
+    with TestClient(main.app) as client:
+        r = client.post("/jobs", json={"url": "http://127.0.0.1:8000/video.mp4"})
+        assert r.status_code == 403
+
+
+def test_progress_url_matches_the_normalized_extraction_url(monkeypatch):
+    monkeypatch.setattr(main, "url_keys", main.TTLCache(8))
+    monkeypatch.setattr(main, "metadata_cache", main.TTLCache(8))
+    main.url_keys.set("https://vimeo.com/123", ("Vimeo", "123"), 60)
+    main.metadata_cache.set(("Vimeo", "123"), {}, 60)
+    with TestClient(main.app) as client:
+        r = client.get("/progress", params={"url": "https://Vimeo.com/123"})
+        assert r.status_code == 200
+        assert '"stage":"done"' in r.text
+        assert client.get("/progress", params={"url": "not a url"}).status_code == 422
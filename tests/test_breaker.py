@@ -0,0 +1,125 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    monkeypatch.setattr(main, "BREAKER_MIN_CALLS", 4)
+    monkeypatch.setattr(main, "BREAKER_ERROR_RATE", 0.5)
+    monkeypatch.setattr(main, "BREAKER_WINDOW", 60)
+    monkeypatch.setattr(main, "BREAKER_COOLDOWN", 30)
+    return main.CircuitBreaker("test")
+
+
+def open_breaker(breaker):
+    for _ in range(4):
+        breaker.record(failed=True)
+
+
+def expire_cooldown(breaker):
+    breaker._opened_at -= main.BREAKER_COOLDOWN + 1
+
+
+def test_breaker_stays_closed_below_min_calls(breaker):
+    for _ in range(3):
+        breaker.record(failed=True)
+    assert breaker.check() is False
+
+
+def test_breaker_opens_on_error_rate(breaker):
+    open_breaker(breaker)
+    with pytest.raises(HTTPException) as e:
+        breaker.check()
+    assert e.value.status_code == 503
+    assert int(e.value.headers["Retry-After"]) > 0
+
+
+def test_breaker_allows_one_trial_after_cooldown(breaker):
+    open_breaker(breaker)
+    expire_cooldown(breaker)
+    assert breaker.check() is True
+    with pytest.raises(HTTPException):
+        breaker.check()
+    breaker.record(failed=False)
+    assert breaker.check() is False
+
+
+def test_breaker_failed_trial_reopens(breaker):
+    open_breaker(breaker)
+    expire_cooldown(breaker)
+    breaker.check()
+    breaker.record(failed=True)
+    with pytest.raises(HTTPException):
+        breaker.check()
+
+
+def test_breaker_ignores_results_started_before_opening(breaker):
+    open_breaker(breaker)
+    breaker.record(failed=False)
+    with pytest.raises(HTTPException):
+        breaker.check()
+
+
+def test_breaker_abandoned_trial_lets_next_request_probe(breaker):
+    open_breaker(breaker)
+    expire_cooldown(breaker)
+    assert breaker.check() is True
+    breaker.abandon()
+    assert breaker.check() is True
+
+
+def test_fetch_video_releases_trial_when_gate_rejects(breaker, monkeypatch):
+    async def reject(*args, **kwargs):
+        raise HTTPException(status_code=429, detail="Too many requests")
+
+    monkeypatch.setitem(main.breakers, "Youtube", breaker)
+    monkeypatch.setattr(main.gate, "run", reject)
+    open_breaker(breaker)
+    expire_cooldown(breaker)
+    url = "https://www.youtube.com/watch?v=abcdefghijk"
+    for _ in range(3):
+        with pytest.raises(HTTPException) as e:
+            run(main._fetch_video(url, url, "Youtube"))
+        assert e.value.status_code == 429
+
+
+def fail_extraction(monkeypatch, message, kind="DownloadError"):
+    async def extract(*args, **kwargs):
+        raise main.ExtractionError(message, kind)
+
+    monkeypatch.setattr(main.gate, "run", extract)
+    monkeypatch.setattr(main, "breakers", main.OrderedDict())
+
+
+def test_client_errors_do_not_open_breakers(breaker, monkeypatch):
+    fail_extraction(monkeypatch, "ERROR: [generic] Unable to download webpage: Failed to resolve 'bad.invalid'"
+                    " ([Errno -2] Name or service not known)")
+    for i in range(8):
+        url = f"https://bad{i}.invalid/v"
+        with pytest.raises(main.ExtractionError):
+            run(main._fetch_video(url, url, None))
+    fail_extraction(monkeypatch, "This URL is a playlist or channel, use /extract-playlist", "PlaylistURL")
+    for _ in range(8):
+        url = "https://www.youtube.com/playlist?list=PL0123"
+        with pytest.raises(main.ExtractionError):
+            run(main._fetch_video(url, url, None))
+    assert all(b._opened_at is None for b in main.breakers.values())
+
+
+def test_failing_host_does_not_block_other_hosts(breaker, monkeypatch):
+    fail_extraction(monkeypatch, "ERROR: [generic] Unable to extract data")
+    for _ in range(4):
+        with pytest.raises(main.ExtractionError):
+            run(main._fetch_video("https://broken.example/v", "https://broken.example/v", None))
+    with pytest.raises(HTTPException) as e:
+        main._breaker(None, "https://broken.example/w").check()
+    assert e.value.status_code == 503
+    assert main._breaker(None, "https://vimeo.com/123").check() is False
@@ -0,0 +1,21 @@
+import main
+
+
+def test_hot_entry_keeps_its_source_under_eviction():
+    cache = main.TTLCache(4)
+    cache.set(("Youtube", "hot"), {}, 60, source="https://youtu.be/hot")
+    for i in range(10):
+        cache.get(("Youtube", "hot"))
+        cache.set(("Youtube", str(i)), {}, 60, source=f"https://youtu.be/{i}")
+    assert (("Youtube", "hot"), "https://youtu.be/hot") in cache.hot(120, 5)
+
+
+def test_hot_skips_cold_entries():
+    cache = main.TTLCache(4)
+    cache.set("a", {}, 60, source="https://example.com/a")
+    cache.set("b", {}, 600, source="https://example.com/b")
+    for _ in range(5):
+        cache.get("a")
+        cache.get("b")
+    cache.set("c", {}, 60, source="https://example.com/c")
+    assert cache.hot(120, 5) == [("a", "https://example.com/a")]
@@ -0,0 +1,86 @@
+import asyncio
+
+import main
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def tick():
+    # دورة واحدة من حلقة الأحداث حتى تصل الإلغاءات إلى المهام
+    await asyncio.sleep(0)
+
+
+def test_fair_queue_skips_cancelled_waiter_on_release():
+    async def scenario():
+        queue = main.FairQueue(1, lambda client: 1.0)
+        await queue.acquire("a")
+        waiter = asyncio.ensure_future(queue.acquire("b"))
+        await tick()
+        waiter.cancel()
+        # الإلغاء وصل إلى future لكن _remove لم يعمل بعد
+        queue.release()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert queue.free == 1
+        assert not queue.locked()
+        await asyncio.wait_for(queue.acquire("c"), 1)
+
+    run(scenario())
+
+
+def test_fair_queue_passes_slot_past_cancelled_waiter():
+    async def scenario():
+        queue = main.FairQueue(1, lambda client: 1.0)
+        await queue.acquire("a")
+        cancelled = asyncio.ensure_future(queue.acquire("b"))
+        live = asyncio.ensure_future(queue.acquire("c"))
+        await tick()
+        cancelled.cancel()
+        queue.release()
+        await asyncio.wait_for(live, 1)
+        await asyncio.gather(cancelled, return_exceptions=True)
+        assert queue.free == 0
+        queue.release()
+        assert queue.free == 1
+
+    run(scenario())
+
+
+def test_fair_queue_round_robin_between_clients():
+    async def scenario():
+        queue = main.FairQueue(1, lambda client: 1.0)
+        await queue.acquire("setup")
+        order = []
+
+        async def worker(client):
+            await queue.acquire(client)
+            order.append(client)
+
+        tasks = [asyncio.ensure_future(worker("heavy")) for _ in range(4)]
+        await tick()
+        tasks.append(asyncio.ensure_future(worker("light")))
+        await tick()
+        for _ in range(5):
+            queue.release()
+            await tick()
+        await asyncio.gather(*tasks)
+        # العميل ذو الطلب الواحد لا ينتظر كل طلبات العميل الآخر
+        assert order.index("light") <= 1
+
+    run(scenario())
+
+
+def test_fair_queue_cancel_while_waiting_removes_waiter():
+    async def scenario():
+        queue = main.FairQueue(1, lambda client: 1.0)
+        await queue.acquire("a")
+        waiter = asyncio.ensure_future(queue.acquire("b"))
+        await tick()
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert queue.waiting == 0
+        queue.release()
+        assert queue.free == 1
+
+    run(scenario())
@@ -0,0 +1,73 @@
+import os
+import sqlite3
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def directory(tmp_path):
+    return str(tmp_path)
+
+
+def make_queue(directory):
+    return main.JobQueue(os.path.join(directory, "jobs.db"), directory, 1)
+
+
+def test_cancel_reaches_job_running_in_another_process(directory):
+    owner = make_queue(directory)
+    other = make_queue(directory)
+    job_id = owner.submit("https://example.com/v", {}, 0)
+    assert owner._claim()[0] == job_id
+    owner._running.add(job_id)
+
+    assert other.cancel(job_id) == "running"
+    assert not other._cancelled
+    with pytest.raises(main.JobCancelled):
+        owner.report(job_id, {"stage": "downloading"}, force=True)
+
+
+def test_cancel_local_job_stops_between_progress_writes(directory):
+    queue = make_queue(directory)
+    job_id = queue.submit("https://example.com/v", {}, 0)
+    queue._claim()
+    queue._running.add(job_id)
+    queue.report(job_id, {"stage": "downloading"}, force=True)
+    queue.cancel(job_id)
+    with pytest.raises(main.JobCancelled):
+        queue.report(job_id, {"stage": "downloading"})
+
+
+def test_recover_finishes_cancelled_job_of_dead_owner(directory, monkeypatch):
+    queue = make_queue(directory)
+    job_id = queue.submit("https://example.com/v", {}, 0)
+    queue._claim()
+    queue.cancel(job_id)
+    monkeypatch.setattr(os, "getpid", lambda: -1)
+    monkeypatch.setattr(main, "_pid_alive", lambda pid: False)
+    queue._recover()
+    assert queue.get(job_id)["state"] == "cancelled"
+
+
+def test_existing_database_gains_cancel_column(directory):
+    conn = sqlite3.connect(os.path.join(directory, "jobs.db"))
+    conn.execute(
+        "CREATE TABLE jobs (id TEXT PRIMARY KEY, url TEXT NOT NULL, options TEXT NOT NULL, priority INTEGER NOT NULL,"
+        " state TEXT NOT NULL, progress TEXT NOT NULL, file TEXT, error TEXT, owner INTEGER,"
+        " created REAL NOT NULL, updated REAL NOT NULL)"
+    )
+    conn.close()
+    queue = make_queue(directory)
+    job_id = queue.submit("https://example.com/v", {}, 0)
+    queue._claim()
+    assert queue.cancel(job_id) == "running"
+
+
+def test_cancelled_queued_job_is_never_claimed(directory):
+    queue = make_queue(directory)
+    other = make_queue(directory)
+    job_id = queue.submit("https://example.com/v", {}, 0)
+    assert queue.cancel(job_id) == "queued"
+    assert other._claim() is None
+    assert other.get(job_id)["state"] == "cancelled"
@@ -0,0 +1,19 @@
+from starlette.requests import Request
+
+import main
+
+
+def make_request(forwarded=None, peer="10.0.0.5"):
+    headers = [(b"x-forwarded-for", forwarded.encode())] if forwarded else []
+    return Request({"type": "http", "headers": headers, "client": (peer, 1234)})
+
+
+def test_client_is_the_peer_without_trusted_proxies():
+    assert main._client_id(make_request("1.2.3.4")) == "ip:10.0.0.5"
+
+
+def test_client_comes_from_the_trusted_forwarded_hop(monkeypatch):
+    monkeypatch.setattr(main, "TRUSTED_PROXY_HOPS", 1)
+    # العنصر الأول أضافه العميل بنفسه، والأخير أضافه الـ proxy الموثوق
+    assert main._client_id(make_request("6.6.6.6, 1.2.3.4")) == "ip:1.2.3.4"
+    assert main._client_id(make_request()) == "ip:10.0.0.5"
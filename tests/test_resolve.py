@@ -0,0 +1,28 @@
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+def fmt(format_id, height, vcodec, acodec, tbr):
+    return main.Format(format_id, "mp4", None, height, None, None, vcodec, acodec, tbr, None, None, "https://cdn.example.com/" + format_id, None)
+
+
+def video():
+    return {"formats": [
+        fmt("18", 360, "avc1", "mp4a", 500),
+        fmt("137", 1080, "avc1", "none", 4000),
+        fmt("140", None, "none", "mp4a", 128),
+    ]}
+
+
+def test_spec_selects_one_merge():
+    chosen = main._resolve(video(), format_spec="bv+ba")
+    assert [f.format_id for f in chosen] == ["137", "140"]
+
+
+@pytest.mark.parametrize("spec", ["all", "bv,ba"])
+def test_spec_selecting_several_formats_is_rejected(spec):
+    with pytest.raises(HTTPException) as e:
+        main._resolve(video(), format_spec=spec)
+    assert e.value.status_code == 400
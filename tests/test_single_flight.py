@@ -0,0 +1,93 @@
+import asyncio
+
+import main
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def tick():
+    # دورة واحدة من حلقة الأحداث حتى تصل الإلغاءات إلى المهام
+    await asyncio.sleep(0)
+
+
+def test_single_flight_shares_one_call():
+    async def scenario():
+        flights = main.SingleFlight()
+        calls = 0
+
+        async def fetch():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return "value"
+
+        results = await asyncio.gather(*(flights.do("k", fetch) for _ in range(5)))
+        assert results == ["value"] * 5
+        assert calls == 1
+        assert not flights.pending("k")
+
+    run(scenario())
+
+
+def test_single_flight_propagates_errors_to_all_waiters():
+    async def scenario():
+        flights = main.SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError("boom")
+
+        results = await asyncio.gather(*(flights.do("k", fail) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(r, ValueError) for r in results)
+        assert not flights.pending("k")
+
+    run(scenario())
+
+
+def test_single_flight_survives_one_waiter_leaving():
+    async def scenario():
+        flights = main.SingleFlight()
+        release = asyncio.Event()
+
+        async def fetch():
+            await release.wait()
+            return "value"
+
+        leaving = asyncio.ensure_future(flights.do("k", fetch))
+        staying = asyncio.ensure_future(flights.do("k", fetch))
+        await tick()
+        leaving.cancel()
+        await asyncio.gather(leaving, return_exceptions=True)
+        assert flights.pending("k")
+        release.set()
+        assert await staying == "value"
+
+    run(scenario())
+
+
+def test_single_flight_cancels_work_when_last_waiter_leaves():
+    async def scenario():
+        flights = main.SingleFlight()
+        started = asyncio.Event()
+        cancelled = False
+
+        async def fetch():
+            nonlocal cancelled
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled = True
+                raise
+
+        waiter = asyncio.ensure_future(flights.do("k", fetch))
+        await started.wait()
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        await tick()
+        assert cancelled
+        assert not flights.pending("k")
+
+    run(scenario())
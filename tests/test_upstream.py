@@ -0,0 +1,48 @@
+import asyncio
+import socket
+
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+class RecordingBackend:
+    def __init__(self):
+        self.hosts = []
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        self.hosts.append(host)
+        return object()
+
+
+def connect(host, answers, monkeypatch):
+    inner = RecordingBackend()
+
+    async def getaddrinfo(self, host, port, **kwargs):
+        return [(socket.AF_INET6 if ":" in a else socket.AF_INET, socket.SOCK_STREAM, 6, "", (a, port)) for a in answers]
+
+    monkeypatch.setattr(asyncio.BaseEventLoop, "getaddrinfo", getaddrinfo)
+    asyncio.run(main.PublicNetworkBackend(inner).connect_tcp(host, 443))
+    return inner.hosts
+
+
+def test_connects_to_the_checked_address(monkeypatch):
+    assert connect("cdn.example.com", ["93.184.216.34"], monkeypatch) == ["93.184.216.34"]
+
+
+@pytest.mark.parametrize("answers", [["10.0.0.1"], ["93.184.216.34", "127.0.0.1"], ["::ffff:127.0.0.1"], ["169.254.169.254"]])
+def test_refuses_private_addresses(answers, monkeypatch):
+    with pytest.raises(HTTPException) as e:
+        connect("cdn.example.com", answers, monkeypatch)
+    assert e.value.status_code == 403
+
+
+def test_refuses_private_ip_literal(monkeypatch):
+    with pytest.raises(HTTPException):
+        connect("127.0.0.1", [], monkeypatch)
+
+
+def test_allow_private_skips_the_check(monkeypatch):
+    monkeypatch.setattr(main, "UPSTREAM_ALLOW_PRIVATE", True)
+    assert connect("localhost", ["127.0.0.1"], monkeypatch) == ["localhost"]